@@ -0,0 +1,82 @@
+"""Check the bisect classifiers in openweather against a linear scan of the tables, then time them.
+
+    python -m bench.classifiers [values]
+
+The check covers every range boundary and the floats on either side of it, values outside the
+tables and NaN, plus random values, through both the scalar and the array paths.
+"""
+
+import math
+import random
+import sys
+import timeit
+
+import numpy as np
+
+import openweather
+
+def scan_cardinal(degrees, long=False):
+    for direction in openweather.CARDINAL_DIRECTIONS:
+        if direction['min'] <= degrees < direction['max']:
+            if long == True:
+                return direction['name']
+            return direction['abbr']
+    return 'nowhere'
+
+def scan_visibility(feet):
+    for distance in openweather.DISTANCE_STRINGS:
+        if distance['min'] <= feet < distance['max']:
+            if callable(distance['desc']):
+                return distance['desc'](feet)
+            else:
+                return distance['desc']
+    return 'unclear at this time'
+
+def scan_moon_phase(moon_phase):
+    for phase in openweather.MOON_PHASES:
+        if phase['min'] <= moon_phase < phase['max']:
+            return phase['name']
+    return 'a mystery'
+
+def edge_values(table, low, high, n):
+    """Every boundary, its neighbouring floats, out-of-range values, NaN and n random values"""
+    values = [math.nan, math.inf, -math.inf]
+    for entry in table:
+        for bound in (entry['min'], entry['max']):
+            values += [bound, math.nextafter(bound, -math.inf), math.nextafter(bound, math.inf)]
+    values += [random.uniform(low, high) for _ in range(n)]
+    return values
+
+CASES = (
+    ('degrees_to_cardinal', scan_cardinal, openweather.degrees_to_cardinal, openweather.CARDINAL_DIRECTIONS, -10, 370),
+    ('degrees_to_cardinal(long)', lambda d: scan_cardinal(d, long=True), lambda d: openweather.degrees_to_cardinal(d, long=True),
+     openweather.CARDINAL_DIRECTIONS, -10, 370),
+    ('visibility_to_string', scan_visibility, openweather.visibility_to_string, openweather.DISTANCE_STRINGS, -100, 1200000),
+    ('moon_phase_string', scan_moon_phase, openweather.moon_phase_string, openweather.MOON_PHASES, -0.1, 1.1),
+)
+
+def check(n):
+    for name, reference, classify, table, low, high in CASES:
+        values = edge_values(table, low, high, n)
+        expected = [reference(value) for value in values]
+        scalar = [classify(value) for value in values]
+        array = classify(np.array(values)).tolist()
+        assert scalar == expected, name + ': scalar results differ from the table scan'
+        assert array == expected, name + ': array results differ from the table scan'
+        print('{:<28} {} values match'.format(name, len(values)))
+
+def benchmark(n):
+    for name, reference, classify, table, low, high in CASES:
+        values = [random.uniform(low, high) for _ in range(n)]
+        array = np.array(values)
+        scan = timeit.timeit(lambda: [reference(value) for value in values], number=1)
+        scalar = timeit.timeit(lambda: [classify(value) for value in values], number=1)
+        vector = timeit.timeit(lambda: classify(array), number=1)
+        print('{:<28} scan {:7.1f} ns  bisect {:7.1f} ns  array {:7.1f} ns  per value'.format(
+            name, scan / n * 1e9, scalar / n * 1e9, vector / n * 1e9))
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(0)
+    check(n)
+    benchmark(n)
@@ -0,0 +1,147 @@
+"""A local stand-in for the SDM and OpenWeather APIs that replays the JSON fixtures in bench/fixtures.
+
+    server = FakeServer(devices=8, latency=0.05)
+    server.start()
+    api = server.nest_api(tmp_dir)      # a nest.Nest_Api pointed at the server
+    ...
+    server.stop()
+
+Every response is delayed by latency seconds; devices listed in slow_devices (by index) take
+slow_latency seconds instead, to see how one slow thermostat affects a poll. Request counts per
+route are kept in server.requests.
+"""
+
+import collections
+import copy
+import datetime
+import json
+import os
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import nest
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+PROJECT_ID = 'homelog-bench'
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive, so pooled sessions reuse connections
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client timed out and hung up, which is what slow devices are for
+            pass
+
+    def do_POST(self):
+        self.server.fake.count('token')
+        self.server.fake.wait()
+        self._reply(self.server.fake.token)
+
+    def do_GET(self):
+        fake = self.server.fake
+        path = urllib.parse.urlparse(self.path).path
+        devices_path = '/v1/enterprises/{}/devices'.format(PROJECT_ID)
+        if path == devices_path:
+            fake.count('devices')
+            fake.wait()
+            self._reply({'devices': fake.devices})
+        elif path.startswith(devices_path + '/'):
+            fake.count('device')
+            index = fake.device_index.get(path[len('/v1/'):])
+            if index is None:
+                self._reply({'error': {'code': 404, 'status': 'NOT_FOUND'}}, 404)
+                return
+            fake.wait(index)
+            self._reply(fake.device_response(index))
+        elif path == '/data/3.0/onecall':
+            fake.count('onecall')
+            fake.wait()
+            self._reply(fake.onecall)
+        else:
+            self._reply({'error': 'not found'}, 404)
+
+class FakeServer():
+    def __init__(self, devices=2, latency=0.0, slow_devices=(), slow_latency=5.0) -> None:
+        self.latency = latency
+        self.slow_devices = set(slow_devices)
+        self.slow_latency = slow_latency
+        self.token = load_fixture('token.json')
+        self.onecall = load_fixture('onecall.json')
+        self.device_template = load_fixture('sdm_device.json')
+        self.devices = []
+        self.device_index = {}
+        for i in range(devices):
+            device = copy.deepcopy(self.device_template)
+            device['name'] = 'enterprises/{}/devices/bench-{:04d}'.format(PROJECT_ID, i)
+            self.devices.append(device)
+            self.device_index[device['name']] = i
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+        self.httpd = None
+
+    def count(self, route):
+        with self.lock:
+            self.requests[route] += 1
+
+    def wait(self, device=None):
+        delay = self.slow_latency if device in self.slow_devices else self.latency
+        if delay:
+            time.sleep(delay)
+
+    def device_response(self, index):
+        """The device fixture with a slowly drifting temperature so consecutive polls differ"""
+        device = copy.deepcopy(self.devices[index])
+        traits = device['traits']
+        traits['sdm.devices.traits.Temperature']['ambientTemperatureCelsius'] += (time.time() % 600) / 600 + index / 10
+        return device
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.httpd.server_address[1])
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        threading.Thread(target=self.httpd.serve_forever, name='FakeServer', daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def onecall_url(self):
+        return self.url + 'data/3.0/onecall'
+
+    def nest_api(self, config_dir, **kwargs):
+        """Return a nest.Nest_Api with fake credentials that talks to this server"""
+        config_file = os.path.join(config_dir, 'nest_api_config.json')
+        expiration = datetime.datetime.now() + datetime.timedelta(hours=1)
+        with open(config_file, 'w') as f:
+            json.dump({
+                'project_id': PROJECT_ID,
+                'client_id': 'bench-client',
+                'client_secret': 'bench-secret',
+                'redirect_uri': 'https://www.google.com',
+                'authorization_code': '4/bench',
+                'refresh_token': '1//bench',
+                'access_token': 'Bearer bench',
+                'access_token_expiration': expiration.isoformat(),
+            }, f)
+        return nest.Nest_Api(config_file, api_url=self.url + 'v1/', token_url=self.url + 'oauth2/v4/token', **kwargs)
@@ -0,0 +1,327 @@
+"""Offline end-to-end benchmarks for the logger.
+
+    python -m bench.run [--devices 8] [--days 365] [--latency 0.05] [--output results.json] [benchmark ...]
+
+Nothing talks to Google or OpenWeather: API calls go to bench.fake_server, and history comes
+from bench.synthetic. Results are printed as JSON (or written to --output) together with the
+commit they were measured at, so runs can be compared across commits. Progress goes to stderr.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import db_writer
+import delta
+import export
+import log_temperature
+import metrics
+import openweather
+import retention
+import rollup
+import schema
+import series
+import state_cache
+import weather_ingest
+from bench import synthetic
+from bench.fake_server import FakeServer, load_fixture
+
+BENCHMARKS = []
+
+def benchmark(function):
+    BENCHMARKS.append(function)
+    return function
+
+def timed(function, *args, **kwargs):
+    """Return (seconds, result) of one call"""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'p50_s': statistics.median(samples),
+        'p95_s': samples[min(int(len(samples) * 0.95), len(samples) - 1)],
+        'max_s': samples[-1],
+    }
+
+@benchmark
+def poll_cycle(args, tmp):
+    """Latency of get_and_parse_stats against the fake API, with and without one unresponsive device"""
+    results = {}
+    for name, slow_devices in (('all_responsive', ()), ('one_slow_device', (0,))):
+        server = FakeServer(devices=args.devices, latency=args.latency, slow_devices=slow_devices, slow_latency=3)
+        server.start()
+        api = server.nest_api(tmp, timeout=1)
+        conn = db_writer.connect(os.path.join(tmp, 'poll_{}.db'.format(name)))
+        schema.create_tables(conn)
+        writer = db_writer.BatchWriter(conn, max_age=None)
+        samples = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(args.cycles):
+                elapsed, _ = timed(log_temperature.get_and_parse_stats, api, writer)
+                samples.append(elapsed)
+        writer.close()
+        results[name] = dict(summarize(samples), requests=dict(server.requests), rows=writer.rows_written)
+        server.stop()
+        conn.close()
+    return results
+
+@benchmark
+def insert(args, tmp):
+    """Throughput of writing synthetic history through the BatchWriter"""
+    conn = db_writer.connect(args.db)
+    schema.create_tables(conn)
+    elapsed, rows = timed(synthetic.populate, conn, args.devices, args.days)
+    conn.close()
+    return {'rows': rows, 'seconds': elapsed, 'rows_per_s': rows / elapsed, 'db_bytes': os.path.getsize(args.db)}
+
+@benchmark
+def rollups(args, tmp):
+    """Full backfill of the rollups, then an incremental update after one more poll cycle"""
+    conn = db_writer.connect(args.db)
+    rollup.create_tables(conn)
+    with conn:
+        conn.execute('DELETE FROM rollup_hourly')
+        conn.execute('DELETE FROM rollup_daily')
+        conn.execute('DELETE FROM rollup_state')
+    backfill, _ = timed(rollup.backfill, conn)
+    newest = conn.execute('SELECT max(timestamp) FROM device_stats').fetchone()[0]
+    names = [row[0] for row in conn.execute('SELECT value FROM device_lookup')]
+    with db_writer.BatchWriter(conn, max_age=None) as writer:
+        writer.write_many([(newest + 300, 70.0, 50.0, 51.0, name, 'ONLINE', 'OFF', 'HEAT', 'OFF', 62.0, 80.0, 69.0) for name in names])
+    update, _ = timed(rollup.update, conn)
+    conn.close()
+    return {'backfill_s': backfill, 'incremental_update_s': update}
+
+@benchmark
+def query(args, tmp):
+    """Range reads: columnar load_series against plain tuples, and rollup.query at each resolution"""
+    conn = db_writer.connect(args.db)
+    device = conn.execute('SELECT value FROM device_lookup ORDER BY id').fetchone()[0]
+    start, end = conn.execute('SELECT min(timestamp), max(timestamp) + 1 FROM device_stats').fetchone()
+    columnar, array = timed(series.load_series, conn, device, start, end)
+    tuples, rows = timed(lambda: conn.execute('SELECT timestamp, temperature, relative_humidity, dew_point FROM device_readings '
+                                              'WHERE device_id = ? AND timestamp >= ? AND timestamp < ?', (device, start, end)).fetchall())
+    results = {
+        'rows': len(array),
+        'load_series_s': columnar,
+        'load_series_rows_per_s': len(array) / columnar,
+        'load_series_bytes': array.nbytes,
+        'tuples_s': tuples,
+    }
+    for name, span in (('day', 86400), ('month', 30 * 86400), ('year', 365 * 86400)):
+        elapsed, points = timed(rollup.query, conn, device, end - span, end)
+        results['rollup_query_{}'.format(name)] = {'s': elapsed, 'points': len(points),
+                                                    'resolution': rollup.choose_resolution(end - span, end)}
+    conn.close()
+    return results
+
+@benchmark
+def delta_storage(args, tmp):
+    """Database size and read/write speed with full rows against delta (change-only) storage"""
+    results = {}
+    days = min(args.days, 90)
+    for mode in ('rows', 'delta'):
+        path = os.path.join(tmp, 'storage_{}.db'.format(mode))
+        conn = db_writer.connect(path)
+        if mode == 'delta':
+            delta.create_tables(conn)
+        else:
+            schema.create_tables(conn)
+        insert, rows = timed(synthetic.populate, conn, args.devices, days)
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        device = conn.execute('SELECT value FROM device_lookup ORDER BY id').fetchone()[0]
+        load, _ = timed(series.load_series, conn, device, fields=('temperature', 'set_point', 'mode'))
+        rollup.create_tables(conn)
+        backfill, _ = timed(rollup.backfill, conn)
+        results[mode] = {'rows': rows, 'db_bytes': os.path.getsize(path), 'insert_rows_per_s': rows / insert,
+                         'load_series_s': load, 'rollup_backfill_s': backfill}
+        conn.close()
+    results['size_ratio'] = results['delta']['db_bytes'] / results['rows']['db_bytes']
+    return results
+
+@benchmark
+def export_history(args, tmp):
+    """Full partitioned export of the synthetic history, then an incremental run after one more poll cycle"""
+    conn = db_writer.connect(args.db)
+    output = os.path.join(tmp, 'export')
+    full, summary = timed(export.export, conn, output, 'day', full=True)
+    newest = conn.execute('SELECT max(timestamp) FROM device_stats').fetchone()[0]
+    names = [row[0] for row in conn.execute('SELECT value FROM device_lookup')]
+    with db_writer.BatchWriter(conn, max_age=None) as writer:
+        writer.write_many([(newest + 300, 70.0, 50.0, 51.0, name, 'ONLINE', 'OFF', 'HEAT', 'OFF', 62.0, 80.0, 69.0) for name in names])
+    incremental, changed = timed(export.export, conn, output, 'day')
+    conn.close()
+    rows = summary['device_stats'][1]
+    return {
+        'format': export.default_format(),
+        'rows': rows,
+        'full_s': full,
+        'full_rows_per_s': rows / full,
+        'incremental_s': incremental,
+        'incremental_partitions': changed['device_stats'][0],
+    }
+
+@benchmark
+def retention_purge(args, tmp):
+    """Deleting all but the last 30 days of raw history in batches, then reclaiming the space"""
+    conn = db_writer.connect(args.db)
+    rollup.create_tables(conn)
+    rollup.update(conn)
+    newest = conn.execute('SELECT max(timestamp) FROM device_stats').fetchone()[0]
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    before = os.path.getsize(args.db)
+    batches = []
+    deleted = 0
+    limit = retention.cutoff(conn, 30, now=newest)
+    with conn:
+        rollup.set_raw_horizon(conn, limit)
+    while True:
+        # Time each batch transaction: that is how long the logger may wait on the write lock
+        changes = conn.total_changes
+        elapsed, _ = timed(conn.execute, retention.DELETE_SQL, (limit, retention.BATCH_SIZE))
+        conn.commit()
+        count = conn.total_changes - changes
+        batches.append(elapsed)
+        deleted += count
+        if count < retention.BATCH_SIZE:
+            break
+    reclaim, pages = timed(retention.reclaim, conn, pause=0)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    after = os.path.getsize(args.db)
+    conn.close()
+    return dict(summarize(batches), deleted=deleted, batches=len(batches), reclaim_s=reclaim, pages_released=pages,
+                db_bytes_before=before, db_bytes_after=after)
+
+@benchmark
+def state_reads(args, tmp):
+    """Warming the state cache from history, then a control-loop read from it against the same read in SQL"""
+    conn = db_writer.connect(args.db)
+    newest = conn.execute('SELECT max(timestamp) FROM device_stats').fetchone()[0]
+    device = conn.execute('SELECT value FROM device_lookup ORDER BY id').fetchone()[0]
+    state = state_cache.StateCache()
+    warm, _ = timed(state.warm, conn, now=newest + 1)
+    calls = 10000
+    def from_cache():
+        for _ in range(calls):
+            state.latest(device)
+            state.mean(device, 'temperature')
+            state.slope(device, 'temperature')
+    def from_sql():
+        for _ in range(calls // 100):
+            conn.execute('SELECT * FROM device_readings WHERE device_id = ? ORDER BY timestamp DESC LIMIT 1', (device,)).fetchone()
+            conn.execute('SELECT avg(temperature) FROM device_readings WHERE device_id = ? AND timestamp >= ?',
+                         (device, newest - state.capacity * 300)).fetchone()
+    cache, _ = timed(from_cache)
+    sql, _ = timed(from_sql)
+    conn.close()
+    return {'warm_s': warm, 'cache_read_us': cache / calls * 1e6, 'sql_read_us': sql / (calls // 100) * 1e6}
+
+@benchmark
+def forecast(args, tmp):
+    """Decoding archived One Call responses into columns against formatting them into strings"""
+    responses = synthetic.onecall_responses(load_fixture('onecall.json'), args.responses)
+    hours = sum(len(response['hourly']) for response in responses)
+    decode_hourly, _ = timed(openweather.decode_many, responses, openweather.decode_hourly)
+    decode_daily, _ = timed(openweather.decode_many, responses, openweather.decode_daily)
+    format_hourly, _ = timed(lambda: [openweather.get_hourly_forecast(response) for response in responses])
+    format_daily, _ = timed(lambda: [openweather.get_daily_forecast(response) for response in responses])
+    return {
+        'responses': len(responses),
+        'hours_per_s_decoded': hours / decode_hourly,
+        'hours_per_s_formatted': hours / format_hourly,
+        'decode_daily_s': decode_daily,
+        'format_daily_s': format_daily,
+    }
+
+@benchmark
+def weather(args, tmp):
+    """One Call ingestion against the fake API: a cold fetch and store, then cached lookups"""
+    server = FakeServer(latency=args.latency)
+    server.start()
+    conn = db_writer.connect(os.path.join(tmp, 'weather.db'))
+    ingest = weather_ingest.WeatherIngest(conn, 'bench-key', url=server.onecall_url())
+    cold, _ = timed(ingest.get, 40.71, -74.01)
+    cached, _ = timed(lambda: [ingest.get(40.71, -74.01) for _ in range(1000)])
+    server.stop()
+    conn.close()
+    return {'cold_fetch_s': cold, 'cached_get_us': cached / 1000 * 1e6, 'api_calls': server.requests['onecall']}
+
+@benchmark
+def metrics_overhead(args, tmp):
+    """Cost of an instrumented block with metrics disabled and enabled"""
+    calls = 200000
+    def block():
+        for _ in range(calls):
+            with metrics.timer('bench_seconds', endpoint='bench'):
+                pass
+            metrics.inc('bench_total', endpoint='bench')
+    was_enabled = metrics.ENABLED
+    metrics.disable()
+    disabled, _ = timed(block)
+    metrics.enable()
+    enabled, _ = timed(block)
+    if not was_enabled:
+        metrics.disable()
+    return {'disabled_ns_per_call': disabled / calls * 1e9, 'enabled_ns_per_call': enabled / calls * 1e9}
+
+def commit():
+    """Return the current commit and whether the tree has uncommitted changes"""
+    try:
+        sha = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True).stdout.strip())
+        return sha, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('--devices', type=int, default=8)
+    parser.add_argument('--days', type=int, default=365, help='days of synthetic history')
+    parser.add_argument('--latency', type=float, default=0.05, help='fake API latency in seconds')
+    parser.add_argument('--cycles', type=int, default=10, help='poll cycles to time')
+    parser.add_argument('--responses', type=int, default=500, help='One Call responses to decode')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    selected = [function for function in BENCHMARKS if not args.benchmarks or function.__name__ in args.benchmarks]
+    sha, dirty = commit()
+    report = {
+        'commit': sha,
+        'dirty': dirty,
+        'time': int(time.time()),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'params': {key: value for key, value in vars(args).items() if key not in ('benchmarks', 'output')},
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        args.db = os.path.join(tmp, 'history.db')
+        for function in selected:
+            if function in (rollups, query, export_history, retention_purge, state_reads) and not os.path.exists(args.db):
+                print('insert (history for {})'.format(function.__name__), file=sys.stderr)
+                insert(args, tmp)
+            print(function.__name__, file=sys.stderr)
+            report['results'][function.__name__] = function(args, tmp)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Load generator for sensor_server.
+
+    python -m bench.sensor_load [--protocol udp|http] [--sensors 50] [--rate 5000] [--seconds 10] [--batch 1]
+
+Starts a SensorServer in a child process writing to a temporary database (or targets a running one
+with --host/--port), then has the given number of simulated sensors send readings at a fixed
+total rate. Every reading carries its own timestamp, so each one is a distinct row. At the end the
+server reports how many readings it accepted, dropped and wrote and its peak memory, and the rows
+in the database are counted. Results are printed as JSON.
+
+--rate 0 sends as fast as possible, to find the ceiling; --batch sends that many readings per
+datagram or request.
+"""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+
+import db_writer
+import schema
+import sensor_server
+
+def _serve(db, protocol, ports, stop, report):
+    """Child process: run a server until stop is set, then report its counters"""
+    conn = db_writer.connect(db)
+    schema.create_tables(conn)
+    sink = db_writer.BatchWriter(conn, max_rows=sensor_server.BATCH_SIZE, max_age=5)
+    server = sensor_server.SensorServer(sink, '127.0.0.1', udp_port=0 if protocol == 'udp' else None,
+                                        http_port=0 if protocol == 'http' else None)
+    server.start()
+    ports.put(server.udp_port if protocol == 'udp' else server.http_port)
+    stop.wait()
+    server.stop()
+    sink.close()
+    conn.close()
+    report.put({
+        'accepted': server.accepted,
+        'dropped': server.dropped,
+        'invalid': server.invalid,
+        'written': server.written,
+        'write_errors': server.write_errors,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'cpu_s': time.process_time(),
+    })
+
+def payloads(sensors, batch, start):
+    """Yield compact payloads of batch readings, cycling through the sensors"""
+    sequence = 0
+    while True:
+        lines = []
+        for _ in range(batch):
+            sensor = sequence % sensors
+            lines.append('bench-sensor-{:03d},{:.1f},{:.1f},{}'.format(sensor, 20 + sequence % 50 / 10, 40 + sequence % 30,
+                                                                   start + sequence // sensors))
+            sequence += 1
+        yield '\n'.join(lines).encode()
+
+def send(protocol, host, port, sensors, rate, seconds, batch):
+    """Send readings for seconds at rate readings per second (0: unthrottled). Returns (readings sent, responses by status)."""
+    # Timestamps in the past, one per reading per sensor, so the run never collides with itself
+    start = int(time.time()) - 10 ** 7
+    generator = payloads(sensors, batch, start)
+    statuses = {}
+    if protocol == 'udp':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        def deliver(payload):
+            sock.sendto(payload, (host, port))
+    else:
+        client = http.client.HTTPConnection(host, port, timeout=10)
+        def deliver(payload):
+            client.request('POST', '/readings', payload, {'Content-Type': 'text/plain'})
+            response = client.getresponse()
+            response.read()
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+    sent = 0
+    began = time.perf_counter()
+    end = began + seconds
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        if rate and sent >= (now - began) * rate:
+            time.sleep(min(batch / rate, end - now))
+            continue
+        deliver(next(generator))
+        sent += batch
+    return sent, time.perf_counter() - began, statuses
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--protocol', choices=('udp', 'http'), default='udp')
+    parser.add_argument('--sensors', type=int, default=50)
+    parser.add_argument('--rate', type=int, default=5000, help='readings per second across all sensors (0: unthrottled)')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--batch', type=int, default=1, help='readings per datagram or request')
+    parser.add_argument('--host', help='target a running server instead of starting one')
+    parser.add_argument('--port', type=int)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server = None
+        if args.host:
+            host, port = args.host, args.port or (sensor_server.UDP_PORT if args.protocol == 'udp' else sensor_server.HTTP_PORT)
+        else:
+            db = os.path.join(tmp, 'sensors.db')
+            ports, report, stop = multiprocessing.Queue(), multiprocessing.Queue(), multiprocessing.Event()
+            server = multiprocessing.Process(target=_serve, args=(db, args.protocol, ports, stop, report))
+            server.start()
+            host, port = '127.0.0.1', ports.get(timeout=10)
+
+        print('sending', file=sys.stderr)
+        sent, elapsed, statuses = send(args.protocol, host, port, args.sensors, args.rate, args.seconds, args.batch)
+        results = {
+            'params': {key: value for key, value in vars(args).items() if key not in ('host', 'port')},
+            'sent': sent,
+            'send_rate': sent / elapsed,
+        }
+        if statuses:
+            results['http_statuses'] = statuses
+        if server is not None:
+            # Give UDP datagrams in flight a moment to land before stopping
+            time.sleep(0.5)
+            stop.set()
+            results['server'] = report.get(timeout=60)
+            server.join()
+            conn = sqlite3.connect(db)
+            results['rows_in_db'] = conn.execute('SELECT count(*) FROM device_stats').fetchone()[0]
+            conn.close()
+            results['stored_rate'] = results['rows_in_db'] / elapsed
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Synthetic history for benchmarks: years of 5-minute readings generated with NumPy.
+
+Temperatures follow a daily cycle with noise, humidity drifts slowly, and the thermostat fields
+change now and then, so the data compresses and aggregates roughly like real logs.
+"""
+
+import copy
+
+import numpy as np
+
+import db_writer
+
+START = 1672531200      # 2023-01-01 00:00 UTC
+INTERVAL = 300
+CHUNK_SIZE = 100000
+
+def readings(devices=4, days=365, start=START, interval=INTERVAL, seed=0, chunk_size=CHUNK_SIZE):
+    """Yield lists of device_stats rows in schema.READING_COLUMNS order, in timestamp order"""
+    rng = np.random.default_rng(seed)
+    ticks = days * 86400 // interval
+    names = ['synthetic-{:03d}'.format(device) for device in range(devices)]
+    ticks_per_chunk = max(chunk_size // devices, 1)
+    for first in range(0, ticks, ticks_per_chunk):
+        count = min(ticks_per_chunk, ticks - first)
+        timestamps = start + (first + np.arange(count)) * interval
+        hour = (timestamps % 86400) / 3600
+        chunk = []
+        for device, name in enumerate(names):
+            temperature = np.round(68 + 4 * np.sin((hour - 9) / 24 * 2 * np.pi) + rng.normal(0, 0.7, count) + device)
+            humidity = np.clip(np.round(50 + 10 * np.sin(timestamps / 86400 / 7) + rng.normal(0, 2, count)), 10, 95)
+            temperature_c = (temperature - 32) * 5 / 9
+            dew_point = np.where(humidity >= 50, np.round((temperature_c - (100 - humidity) / 5) * 9 / 5 + 32), np.nan)
+            heating = temperature < 68 + device
+            set_point = np.where(hour < 7, 64.0, 69.0)
+            eco = (timestamps // 86400) % 30 == device
+            rows = zip(timestamps.tolist(), temperature.tolist(), humidity.tolist(),
+                       [None if np.isnan(value) else value for value in dew_point.tolist()],
+                       [name] * count, ['ONLINE'] * count, np.where(heating, 'HEATING', 'OFF').tolist(),
+                       ['HEAT'] * count, np.where(eco, 'MANUAL_ECO', 'OFF').tolist(),
+                       [62.0] * count, [80.0] * count, set_point.tolist())
+            chunk.append(list(rows))
+        # Interleave devices so rows come out in timestamp order like the logger writes them
+        yield [row for rows in zip(*chunk) for row in rows]
+
+def populate(conn, devices=4, days=365, **kwargs):
+    """Write synthetic history through a BatchWriter. Returns the number of rows written."""
+    with db_writer.BatchWriter(conn, max_rows=CHUNK_SIZE, max_age=None) as writer:
+        for rows in readings(devices, days, **kwargs):
+            writer.write_many(rows)
+    return writer.rows_written
+
+def onecall_responses(template, count, start=START):
+    """Return count One Call responses built from a template, each shifted one hour later"""
+    responses = []
+    for i in range(count):
+        response = copy.deepcopy(template)
+        offset = start - template['hourly'][0]['dt'] + i * 3600
+        for section in ('hourly', 'daily'):
+            for entry in response[section]:
+                entry['dt'] += offset
+        response['current']['dt'] += offset
+        responses.append(response)
+    return responses
@@ -0,0 +1,57 @@
+"""Compare commit-per-row inserts against the batched WAL writer.
+
+Run from the repository root:
+
+    python -m bench.writer [rows]
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import db_writer
+import log_temperature
+import schema
+
+def make_rows(n, start=1700000000, devices=4):
+    """Generate n synthetic device_stats rows"""
+    rows = []
+    for i in range(n):
+        device = 'device-{}'.format(i % devices)
+        rows.append((start + (i // devices) * 300, 70.0, 45.0, None, device, 'ONLINE', 'OFF', 'HEAT', 'OFF', 62.0, 80.0, 68.0))
+    return rows
+
+def bench_commit_per_row(path, rows):
+    conn = sqlite3.connect(path)
+    log_temperature.create_table(conn)
+    # One encoder, as BatchWriter has, so only the commit strategy differs
+    encoder = schema.Encoder(conn)
+    start = time.perf_counter()
+    for row in rows:
+        log_temperature.insert_stats(conn, encoder, row)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed
+
+def bench_batch_writer(path, rows):
+    conn = db_writer.connect(path)
+    log_temperature.create_table(conn)
+    start = time.perf_counter()
+    with db_writer.BatchWriter(conn, max_age=None) as writer:
+        for row in rows:
+            writer.write(row)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed
+
+def main(n=5000):
+    rows = make_rows(n)
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, bench in (('commit per row', bench_commit_per_row), ('batch writer (WAL)', bench_batch_writer)):
+            elapsed = bench(os.path.join(tmp, name.split()[0] + '.db'), rows)
+            print('{:<20} {:>8} rows in {:6.3f} s  {:>10.0f} rows/s'.format(name, n, elapsed, n / elapsed))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,125 @@
+import sqlite3
+import threading
+import time
+
+import metrics
+import schema
+
+# Pragmas applied to every logger connection. WAL lets readers run while the logger writes,
+# and synchronous=NORMAL only fsyncs at checkpoints instead of on every commit. auto_vacuum only
+# takes effect on a new database (retention.convert() switches an existing one).
+PRAGMAS = (
+    ('auto_vacuum', 'INCREMENTAL'),
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+    ('temp_store', 'MEMORY'),
+    ('wal_autocheckpoint', 1000),
+)
+
+def configure(conn):
+    """Apply the logger pragmas to an open connection"""
+    for name, value in PRAGMAS:
+        conn.execute('PRAGMA {} = {}'.format(name, value))
+
+def connect(db_file):
+    """Open a connection to the database in WAL mode"""
+    conn = sqlite3.connect(db_file, check_same_thread=False)
+    configure(conn)
+    return conn
+
+def insert_rows(conn, encoder, rows):
+    """Encode readings and insert them in one transaction. Returns the number of rows changed.
+
+    Duplicates dropped by INSERT OR IGNORE are not counted. In delta storage mode the count is of
+    the underlying tables' rows, as the view's triggers write them.
+    """
+    changes = conn.total_changes
+    try:
+        with metrics.timer('db_flush_seconds'), conn:
+            encoded = [encoder.encode(row) for row in rows]
+            # Lookup values added while encoding are not readings
+            changes = conn.total_changes
+            conn.executemany(schema.INSERT_SQL, encoded)
+    except sqlite3.Error:
+        # New lookup values were rolled back with the transaction
+        encoder.reload()
+        raise
+    inserted = conn.total_changes - changes
+    metrics.inc('db_rows_written_total', inserted)
+    return inserted
+
+class BatchWriter():
+    """Buffer readings and write them to the database in one transaction per batch.
+
+    Readings are in schema.READING_COLUMNS order and are encoded when the batch is written.
+    A batch is flushed when it reaches max_rows, when the oldest buffered row is older than
+    max_age seconds, or when the writer is closed.
+    """
+    def __init__(self, conn, max_rows=500, max_age=30) -> None:
+        self.conn = conn
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.encoder = schema.Encoder(conn)
+        self.rows = []
+        self.oldest = None
+        self.rows_written = 0
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flusher = None
+        if max_age:
+            self.flusher = threading.Thread(target=self._flush_loop, name='BatchWriter', daemon=True)
+            self.flusher.start()
+
+    def write(self, row):
+        """Buffer a single row"""
+        self.write_many((row,))
+
+    def write_many(self, rows):
+        """Buffer several rows, flushing if a threshold is reached"""
+        with self.lock:
+            if self.closed.is_set():
+                raise ValueError("BatchWriter is closed")
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            self.rows.extend(rows)
+            if len(self.rows) >= self.max_rows:
+                self._flush()
+
+    def flush(self):
+        """Write all buffered rows now"""
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.rows:
+            return
+        rows = self.rows
+        insert_rows(self.conn, self.encoder, rows)
+        self.rows_written += len(rows)
+        self.rows = []
+        self.oldest = None
+
+    def _flush_loop(self):
+        while not self.closed.wait(self.max_age / 2):
+            with self.lock:
+                if self.oldest is not None and time.monotonic() - self.oldest >= self.max_age:
+                    try:
+                        self._flush()
+                    except sqlite3.Error as e:
+                        # Keep the rows buffered; the next write or flush will try again
+                        print("Error flushing rows:", e)
+
+    def close(self):
+        """Flush any remaining rows and stop the background flusher"""
+        with self.lock:
+            self._flush()
+            self.closed.set()
+        if self.flusher is not None:
+            self.flusher.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,155 @@
+"""Change-only (delta) storage of device_stats.
+
+Most thermostat fields (connectivity, mode, eco_mode, eco_heat, eco_cool, set_point) stay the same
+for days, yet a plain device_stats row repeats them every 5 minutes. In delta mode each reading
+is split in two:
+
+    device_measurements  (device_id, timestamp) -> temperature, relative_humidity, dew_point, hvac
+    device_state         (device_id, start)     -> the state fields, in force from start until the
+                                                   device's next device_state row
+
+A new device_state row is written only when a device's state changes. device_stats becomes a view
+that rebuilds full rows by joining each measurement to the state in force at its timestamp, an
+as-of lookup that is a single seek on the device_state primary key. INSTEAD OF triggers on the view
+split inserted rows and delete measurements, so everything that reads or writes device_stats
+(schema.INSERT_SQL, rollups, series, exports, retention) works unchanged in either mode.
+
+Late readings are handled: if an inserted reading changes the state in the middle of an interval,
+the old state is restored from the next measurement onward.
+
+Create a new database in delta mode with STORAGE_MODE=delta, or convert an existing one (with the
+logger stopped) with
+
+    python delta.py homelog.db
+
+An interrupted conversion can simply be run again.
+"""
+
+import sqlite3
+import sys
+
+import schema
+
+DB_FILE = 'homelog.db'
+CHUNK_SIZE = 50000
+
+MEASUREMENT_COLUMNS = ('temperature', 'relative_humidity', 'dew_point', 'hvac')
+STATE_COLUMNS = ('connectivity', 'mode', 'eco_mode', 'eco_heat', 'eco_cool', 'set_point')
+
+CREATE_MEASUREMENTS = '''CREATE TABLE IF NOT EXISTS device_measurements
+                         (device_id INTEGER NOT NULL, timestamp INTEGER NOT NULL,
+                          temperature REAL, relative_humidity REAL, dew_point REAL, hvac INTEGER,
+                          PRIMARY KEY (device_id, timestamp)) WITHOUT ROWID'''
+
+CREATE_STATE = '''CREATE TABLE IF NOT EXISTS device_state
+                  (device_id INTEGER NOT NULL, start INTEGER NOT NULL,
+                   connectivity INTEGER, mode INTEGER, eco_mode INTEGER, eco_heat REAL, eco_cool REAL, set_point REAL,
+                   PRIMARY KEY (device_id, start)) WITHOUT ROWID'''
+
+# The start of the state interval in force for a device at a time
+def _as_of(device, timestamp):
+    return '(SELECT max(start) FROM device_state WHERE device_id = {} AND start <= {})'.format(device, timestamp)
+
+CREATE_VIEW = '''CREATE VIEW IF NOT EXISTS device_stats AS
+                 SELECT m.device_id, m.timestamp, m.temperature, m.relative_humidity, m.dew_point,
+                        s.connectivity, m.hvac, s.mode, s.eco_mode, s.eco_heat, s.eco_cool, s.set_point
+                 FROM device_measurements m
+                 LEFT JOIN device_state s ON s.device_id = m.device_id AND s.start = {}'''.format(_as_of('m.device_id', 'm.timestamp'))
+
+# True if the state in force for NEW's device at a time differs from the state in NEW
+_DIFFERS = '''NOT EXISTS (SELECT 1 FROM device_state WHERE device_id = NEW.device_id AND start = {} AND {})'''.format(
+    _as_of('NEW.device_id', '{}'), ' AND '.join('{0} IS NEW.{0}'.format(column) for column in STATE_COLUMNS))
+
+# The next measurement of NEW's device after NEW
+_NEXT = '(SELECT min(timestamp) FROM device_measurements WHERE device_id = NEW.device_id AND timestamp > NEW.timestamp)'
+
+CREATE_INSERT_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS device_stats_insert INSTEAD OF INSERT ON device_stats
+    WHEN NOT EXISTS (SELECT 1 FROM device_measurements WHERE device_id = NEW.device_id AND timestamp = NEW.timestamp)
+    BEGIN
+        -- A late reading that changes the state mid-interval: the old state resumes at the next measurement
+        INSERT OR IGNORE INTO device_state
+            SELECT device_id, {next}, {state} FROM device_state
+            WHERE device_id = NEW.device_id AND start = {as_of_new} AND {next} IS NOT NULL AND {differs_new}
+              AND NOT EXISTS (SELECT 1 FROM device_state WHERE device_id = NEW.device_id AND start > NEW.timestamp AND start <= {next});
+        INSERT OR REPLACE INTO device_state
+            SELECT NEW.device_id, NEW.timestamp, {new_state} WHERE {differs_new};
+        INSERT INTO device_measurements VALUES (NEW.device_id, NEW.timestamp, {new_measurements});
+    END'''.format(
+        next=_NEXT,
+        state=', '.join(STATE_COLUMNS),
+        new_state=', '.join('NEW.' + column for column in STATE_COLUMNS),
+        new_measurements=', '.join('NEW.' + column for column in MEASUREMENT_COLUMNS),
+        as_of_new=_as_of('NEW.device_id', 'NEW.timestamp'),
+        differs_new=_DIFFERS.format('NEW.timestamp'))
+
+CREATE_DELETE_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS device_stats_delete INSTEAD OF DELETE ON device_stats
+    BEGIN
+        DELETE FROM device_measurements WHERE device_id = OLD.device_id AND timestamp = OLD.timestamp;
+    END'''
+
+def is_delta(conn):
+    """Return True if device_stats is stored in delta mode"""
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'device_stats'").fetchone()
+    return row is not None and row[0] == 'view'
+
+def create_tables(conn):
+    """Create a new device_stats in delta mode, with its lookup tables and the decoded view"""
+    with conn:
+        conn.execute(CREATE_MEASUREMENTS)
+        conn.execute(CREATE_STATE)
+        conn.execute('CREATE INDEX IF NOT EXISTS device_measurements_timestamp ON device_measurements (timestamp)')
+        conn.execute(CREATE_VIEW)
+        conn.execute(CREATE_INSERT_TRIGGER)
+        conn.execute(CREATE_DELETE_TRIGGER)
+    schema.create_tables(conn)
+
+def prune(conn, before):
+    """Delete state intervals that ended before a time, e.g. after retention removed their measurements"""
+    with conn:
+        return conn.execute('''DELETE FROM device_state WHERE start < ? AND EXISTS
+                               (SELECT 1 FROM device_state later WHERE later.device_id = device_state.device_id
+                                AND later.start > device_state.start AND later.start <= ?)''', (before, before)).rowcount
+
+def convert(conn, chunk_size=CHUNK_SIZE):
+    """Convert a device_stats table to delta mode in place. Returns the number of readings converted.
+
+    The old table is kept as device_stats_rows until every row is copied. The view's insert trigger
+    skips readings already stored, so an interrupted conversion resumes when run again.
+    """
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    if 'device_stats_rows' not in tables:
+        if is_delta(conn):
+            print("device_stats is already in delta mode")
+            return 0
+        with conn:
+            conn.execute('ALTER TABLE device_stats RENAME TO device_stats_rows')
+            conn.execute('DROP INDEX IF EXISTS device_stats_timestamp')
+            conn.execute('DROP VIEW IF EXISTS device_readings')
+    create_tables(conn)
+    total = conn.execute('SELECT count(*) FROM device_stats_rows').fetchone()[0]
+    # Copy each device in timestamp order so only state changes are written
+    cursor = conn.execute('SELECT {} FROM device_stats_rows ORDER BY device_id, timestamp'.format(', '.join(schema.STATS_COLUMNS)))
+    copied = 0
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        with conn:
+            conn.executemany(schema.INSERT_SQL, rows)
+        copied += len(rows)
+        print("Converted {} of {} rows".format(copied, total), end='\r')
+    print()
+    with conn:
+        conn.execute('DROP TABLE device_stats_rows')
+    conn.execute('VACUUM')
+    return copied
+
+if __name__ == '__main__':
+    conn = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else DB_FILE)
+    if schema.is_legacy(conn):
+        raise SystemExit("device_stats uses the old layout; run migrate_db.py first")
+    convert(conn)
+    intervals = conn.execute('SELECT count(*) FROM device_state').fetchone()[0]
+    readings = conn.execute('SELECT count(*) FROM device_measurements').fetchone()[0]
+    print("{} readings, {} state intervals".format(readings, intervals))
+    conn.close()
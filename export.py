@@ -0,0 +1,236 @@
+"""Export homelog.db to day- or month-partitioned Parquet or CSV files for analysis.
+
+    python export.py [homelog.db] [--output exports] [--partition day|month] [--format parquet|csv] [--full]
+
+Each exported table gets a directory of partition files, e.g. exports/device_stats/2024-03.parquet.
+device_stats is exported through the device_readings view, so categorical fields are text. Rows are
+streamed from SQLite in fixed-size chunks and appended to the open partition file, so memory use does
+not grow with the size of the database. Parquet needs pyarrow; without it the export is CSV.
+
+Exports are incremental: manifest.json in the output directory records, for every partition
+written, its signature in the database (row count, time range and, for forecast tables, newest
+fetch time) and the time range of the file. The next run recomputes the signatures from the
+database and rewrites only partitions whose signature changed, so a nightly export touches the
+current day or month. --full rewrites every partition. Partitions that no longer have any rows are
+removed.
+
+Once retention.py has deleted raw readings, the exported device_stats files are the only
+full-resolution copy of them. Files that end before the raw horizon are kept as they are, even by
+--full, and a partition that straddles the horizon is rewritten from the file's rows before the
+horizon followed by the database's rows after it. Changing --format or --partition starts a new
+manifest; files already written in the old layout are left where they are.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import sqlite3
+
+import rollup
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+DB_FILE = 'homelog.db'
+OUTPUT_DIR = 'exports'
+CHUNK_SIZE = 50000
+MANIFEST = 'manifest.json'
+
+# Exported tables: (name, relation rows are read from, time column, column that changes when a row is replaced)
+TABLES = (
+    ('device_stats', 'device_readings', 'timestamp', None),
+    ('weather_current', 'weather_current', 'dt', None),
+    ('weather_hourly', 'weather_hourly', 'dt', 'fetched_at'),
+    ('weather_daily', 'weather_daily', 'dt', 'fetched_at'),
+)
+
+# Partition key of a unix time column, in UTC
+PARTITIONS = {
+    'day': "strftime('%Y-%m-%d', {}, 'unixepoch')",
+    'month': "strftime('%Y-%m', {}, 'unixepoch')",
+}
+
+ARROW_TYPES = {'INTEGER': 'int64', 'REAL': 'float64', 'TEXT': 'string'}
+
+def default_format():
+    return 'parquet' if pyarrow is not None else 'csv'
+
+def signatures(conn, table, time_column, version_column, partition):
+    """Return {partition key: [row count, min time, max time, max version]} for a table"""
+    key = PARTITIONS[partition].format(time_column)
+    version = 'max({})'.format(version_column) if version_column else 'NULL'
+    sql = 'SELECT {0}, count(*), min({1}), max({1}), {2} FROM {3} GROUP BY 1'.format(key, time_column, version, table)
+    return {row[0]: list(row[1:]) for row in conn.execute(sql)}
+
+# Convert CSV text back to the column's type; empty fields are NULL
+CSV_TYPES = {'INTEGER': int, 'REAL': float}
+
+class CsvPartition():
+    """Write one partition as CSV with a header row"""
+    def __init__(self, path, columns, types) -> None:
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def read(path, types, chunk_size=CHUNK_SIZE):
+        """Yield lists of rows from a partition file written by this class"""
+        converters = [CSV_TYPES.get(kind, str) for kind in types]
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            while True:
+                chunk = [tuple(None if value == '' else convert(value) for convert, value in zip(converters, row))
+                         for row in itertools.islice(reader, chunk_size)]
+                if not chunk:
+                    return
+                yield chunk
+
+class ParquetPartition():
+    """Write one partition as Parquet, one row group per chunk"""
+    def __init__(self, path, columns, types) -> None:
+        self.columns = columns
+        self.schema = pyarrow.schema([(column, ARROW_TYPES.get(kind, 'string')) for column, kind in zip(columns, types)])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='zstd')
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        arrays = [pyarrow.array(column, type=field.type) for column, field in zip(columns, self.schema)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+    @staticmethod
+    def read(path, types, chunk_size=CHUNK_SIZE):
+        """Yield lists of rows from a partition file written by this class"""
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield list(zip(*(column.to_pylist() for column in batch.columns)))
+
+WRITERS = {'csv': CsvPartition, 'parquet': ParquetPartition}
+
+def export_partition(conn, relation, time_column, start, end, path, format, chunk_size=CHUNK_SIZE, keep_before=None):
+    """Stream rows with start <= time <= end into a new partition file. Returns the number of rows.
+
+    With keep_before, the rows of the existing file older than that time are written first, and only
+    newer rows are read from the database.
+    """
+    info = conn.execute('PRAGMA table_info({})'.format(relation)).fetchall()
+    columns = [row[1] for row in info]
+    types = [row[2].upper() for row in info]
+    # Write beside the final file and rename, so an interrupted export never leaves a truncated partition
+    partial = path + '.partial'
+    writer = WRITERS[format](partial, columns, types)
+    count = 0
+    try:
+        if keep_before is not None:
+            index = columns.index(time_column)
+            for rows in WRITERS[format].read(path, types, chunk_size):
+                rows = [row for row in rows if row[index] < keep_before]
+                if rows:
+                    writer.write(rows)
+                    count += len(rows)
+            start = max(start, keep_before)
+        cursor = conn.execute('SELECT * FROM {0} WHERE {1} >= ? AND {1} <= ? ORDER BY {1}'.format(relation, time_column), (start, end))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            writer.write(rows)
+            count += len(rows)
+    finally:
+        writer.close()
+    os.replace(partial, path)
+    return count
+
+def load_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(output, manifest):
+    path = os.path.join(output, MANIFEST)
+    with open(path + '.partial', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.partial', path)
+
+def export(conn, output=OUTPUT_DIR, partition='month', format=None, full=False, chunk_size=CHUNK_SIZE):
+    """Export every table that exists to output, rewriting only changed partitions unless full.
+
+    Returns {table: (partitions written, rows written)}.
+    """
+    if partition not in PARTITIONS:
+        raise ValueError("Unknown partitioning: {}".format(partition))
+    format = format or default_format()
+    if format == 'parquet' and pyarrow is None:
+        raise ValueError("Parquet export needs pyarrow; install it or use --format csv")
+    if format not in WRITERS:
+        raise ValueError("Unknown format: {}".format(format))
+
+    os.makedirs(output, exist_ok=True)
+    manifest = load_manifest(output)
+    if manifest.get('format') != format or manifest.get('partition') != partition:
+        manifest = {'format': format, 'partition': partition, 'tables': {}}
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")}
+    summary = {}
+    try:
+        for table, relation, time_column, version_column in TABLES:
+            if table not in existing or relation not in existing:
+                continue
+            directory = os.path.join(output, table)
+            os.makedirs(directory, exist_ok=True)
+            exported = manifest['tables'].setdefault(table, {})
+            current = signatures(conn, table, time_column, version_column, partition)
+            # Raw rows before the horizon were deleted by retention; the files hold the only copy
+            horizon = rollup.raw_horizon(conn) if table == 'device_stats' and 'rollup_state' in existing else None
+            written = rows = 0
+            for key in sorted(set(current) | set(exported)):
+                path = os.path.join(directory, '{}.{}'.format(key, format))
+                entry = exported.get(key)
+                signature = current.get(key)
+                exists = entry is not None and os.path.exists(path)
+                if exists and horizon is not None and entry['end'] < horizon:
+                    continue
+                if signature is None:
+                    if os.path.exists(path):
+                        os.remove(path)
+                    exported.pop(key, None)
+                    continue
+                if exists and entry['signature'] == signature and not full:
+                    continue
+                keep_before = horizon if exists and horizon is not None and entry['start'] < horizon else None
+                rows += export_partition(conn, relation, time_column, signature[1], signature[2], path, format, chunk_size, keep_before)
+                exported[key] = {'signature': signature, 'start': entry['start'] if keep_before else signature[1], 'end': signature[2]}
+                written += 1
+            summary[table] = (written, rows)
+    finally:
+        # Record whatever was finished, so an interrupted export resumes where it stopped
+        save_manifest(output, manifest)
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export homelog.db to partitioned Parquet or CSV files')
+    parser.add_argument('db', nargs='?', default=DB_FILE)
+    parser.add_argument('--output', default=OUTPUT_DIR, help='directory to write to (default: %(default)s)')
+    parser.add_argument('--partition', choices=sorted(PARTITIONS), default='month')
+    parser.add_argument('--format', choices=sorted(WRITERS), help='default: parquet if pyarrow is installed, else csv')
+    parser.add_argument('--full', action='store_true', help='rewrite every partition, not just changed ones')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    for table, (written, rows) in export(conn, args.output, args.partition, args.format, args.full).items():
+        print("{}: {} partitions, {} rows written".format(table, written, rows))
+    conn.close()
@@ -1,62 +1,125 @@
 import time
-import sqlite3
+from decouple import config
 import nest
+import db_writer
+import delta
+import metrics
+import retention
+import rollup
+import scheduler
+import sensor_server
+import schema
+import spool
+import state_cache
+import weather_ingest
 
 CONFIG_FILE = 'nest_api_config.json'
 DB_FILE = 'homelog.db'
+SPOOL_DIR = 'spool'
+POLL_INTERVAL = 300     # seconds between thermostat polls
+METRICS_INTERVAL = 300  # seconds between metric snapshots
 
 def create_table(conn):
-    """Create a table to store device stats"""
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS device_stats
-                 (timestamp INTEGER, temperature REAL, relative_humidity REAL, dew_point REAL, device_id TEXT, connectivity TEXT, hvac TEXT, mode TEXT, eco_mode TEXT, eco_heat REAL, eco_cool REAL, set_point REAL)''')
-    conn.commit()
-
-def insert_stats(conn, device_stats):
-    """Insert device stats into the database"""
-    c = conn.cursor()
-    c.execute("INSERT INTO device_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", device_stats)
-    conn.commit()
-
-def get_and_parse_stats(api, conn):
-    """Retrieve and parse device stats"""
+    """Create the tables to store device stats"""
+    if schema.is_legacy(conn):
+        raise SystemExit("{} uses the old device_stats layout; run migrate_db.py first".format(DB_FILE))
+    # STORAGE_MODE=delta stores thermostat state only when it changes; it applies to new databases
+    if config('STORAGE_MODE', default='rows') == 'delta' and not delta.is_delta(conn):
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'device_stats'").fetchone():
+            raise SystemExit("{} stores full rows; run delta.py to convert it".format(DB_FILE))
+        delta.create_tables(conn)
+    else:
+        schema.create_tables(conn)
+
+def insert_stats(conn, encoder, device_stats):
+    """Insert device stats into the database and commit them on their own"""
+    with metrics.timer('db_flush_seconds'):
+        c = conn.cursor()
+        c.execute(schema.INSERT_SQL, encoder.encode(device_stats))
+        conn.commit()
+    metrics.inc('db_rows_written_total')
+
+def get_and_parse_stats(api, writer):
+    """Retrieve and parse device stats and hand them to the writer (a spool.Spool or db_writer.BatchWriter)"""
     devices = api.get_devices()
-    for device in devices:
-        device_stats = nest.get_device_stats(device, api)
+    for device, device_stats in nest.get_all_device_stats(devices, api):
         timestamp = int(time.time())
         print('\n', time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)))
-        nest.print_device_stats(device_stats)
-        temperature_c = device_stats['traits']['sdm.devices.traits.Temperature']['ambientTemperatureCelsius']
-        temperature = nest.c_to_f(device_stats['traits']['sdm.devices.traits.Temperature']['ambientTemperatureCelsius'])
-        relative_humidity = device_stats['traits']['sdm.devices.traits.Humidity']['ambientHumidityPercent']
-        if relative_humidity >= 50:
-            dew_point = nest.c_to_f(temperature_c - ((100 - relative_humidity) / 5))
-        else:
-            dew_point = None
-        device_id = device['name'].split('/')[-1]
-        connectivity = device_stats['traits']['sdm.devices.traits.Connectivity']['status']
-        hvac = device_stats['traits']['sdm.devices.traits.ThermostatHvac']['status']
-        mode = device_stats['traits']['sdm.devices.traits.ThermostatMode']['mode']
-        eco_mode = device_stats['traits']['sdm.devices.traits.ThermostatEco']['mode']
-        eco_heat = nest.c_to_f(device_stats['traits']['sdm.devices.traits.ThermostatEco']['heatCelsius'])
-        eco_cool = nest.c_to_f(device_stats['traits']['sdm.devices.traits.ThermostatEco']['coolCelsius'])
-        try:
-            set_point = nest.c_to_f(device_stats['traits']['sdm.devices.traits.ThermostatTemperatureSetpoint']['heatCelsius'])
-        except KeyError:
-            set_point = None
-        insert_stats(conn, (timestamp, temperature, relative_humidity, dew_point, device_id, connectivity, hvac, mode, eco_mode, eco_heat, eco_cool, set_point))
+        reading = nest.decode_device(device_stats, timestamp)
+        nest.print_device_stats(reading)
+        writer.write(reading.as_row())
 
 if __name__ == '__main__':
     # Set up a connection to the SQLite database
-    conn = sqlite3.connect(DB_FILE)
+    conn = db_writer.connect(DB_FILE)
 
     # Create a table in the database to store the device stats
     create_table(conn)
 
+    # Rollups are maintained on their own connection so they never interleave with the drainer's transactions
+    rollup_conn = db_writer.connect(DB_FILE)
+    rollup.create_tables(rollup_conn)
+    rollup.update(rollup_conn)
+
     # Set up authentication with the Nest API
     api = nest.Nest_Api(CONFIG_FILE)
+    api.start_token_refresher()
+
+    # Readings are appended to the spool and moved into the database in the background, so a locked
+    # or unavailable database never blocks a poll; anything left over from a crash is drained first.
+    # Readings replayed after the rollups have moved on get their buckets rebuilt.
+    readings = spool.Spool(SPOOL_DIR)
+    drainer = spool.Drainer(readings, conn, on_commit=lambda rows: rollup.include_late(conn, rows))
+    drainer.start()
+
+    # Latest readings and recent history are kept in memory for control decisions, starting from what
+    # is already in the database; readings go to the cache as well as the spool
+    state = state_cache.StateCache()
+    state.warm(rollup_conn)
+    sink = state_cache.Tee(readings, state)
+
+    def poll_nest():
+        get_and_parse_stats(api, sink)
+
+    # Each source runs on its own wall-clock schedule: the thermostats every 5 minutes, the rollups shortly after
+    sources = scheduler.Scheduler()
+    sources.add(scheduler.Source('nest', poll_nest, interval=POLL_INTERVAL, timeout=60))
+    sources.add(scheduler.Source('rollup', lambda: rollup.update(rollup_conn), interval=POLL_INTERVAL, offset=60, timeout=120))
+
+    # Outdoor weather is polled on its own schedule, on its own connection
+    if config('OPENWEATHER_API_KEY', default=''):
+        weather = weather_ingest.WeatherIngest(db_writer.connect(DB_FILE), config('OPENWEATHER_API_KEY'), state=state)
+        latitude, longitude = config('LATITUDE', cast=float), config('LONGITUDE', cast=float)
+        sources.add(scheduler.Source('weather', lambda: weather.get(latitude, longitude), interval=weather_ingest.POLL_INTERVAL, timeout=30))
+
+    # Raw readings older than RETENTION_DAYS are deleted once a day; without it they are kept forever
+    retention_days = config('RETENTION_DAYS', default=0, cast=int)
+    if retention_days:
+        retention_conn = db_writer.connect(DB_FILE)
+        sources.add(scheduler.Source('retention', lambda: retention.run(retention_conn, retention_days),
+                                     interval=retention.INTERVAL, offset=3 * 3600 + 240, timeout=3600))
+
+    # Metrics are only collected when a port to serve them on is configured
+    metrics_port = config('METRICS_PORT', default=0, cast=int)
+    if metrics_port:
+        metrics.enable()
+        metrics.serve(metrics_port)
+        metrics_conn = db_writer.connect(DB_FILE)
+        metrics.create_table(metrics_conn)
+        sources.add(scheduler.Source('metrics', lambda: metrics.snapshot(metrics_conn), interval=METRICS_INTERVAL, offset=150))
+
+    # Room sensors push readings to their own listener; they are spooled alongside the thermostats'
+    sensors = None
+    sensor_udp_port = config('SENSOR_UDP_PORT', default=0, cast=int)
+    sensor_http_port = config('SENSOR_HTTP_PORT', default=0, cast=int)
+    if sensor_udp_port or sensor_http_port:
+        sensors = sensor_server.SensorServer(sink, udp_port=sensor_udp_port or None, http_port=sensor_http_port or None).start()
 
-    # Define a loop that calls the function every 5 minutes and inserts the results into the database
-    while True:
-        get_and_parse_stats(api, conn)
-        time.sleep(300)  # Wait 5 minutes before calling the function again
\ No newline at end of file
+    try:
+        sources.run()
+    finally:
+        if sensors is not None:
+            sensors.stop()
+        drainer.stop()
+        readings.close()
+        conn.close()
@@ -0,0 +1,195 @@
+"""Counters and latency histograms for the logger's hot paths.
+
+Instrumented code calls inc(), observe() or timer(); until enable() is called these return
+immediately, so the instrumentation costs one global check per call. When enabled, serve() exposes
+the metrics in the Prometheus text format at http://<host>:<port>/metrics and snapshot() writes
+them to the metrics table.
+
+    with metrics.timer('nest_request_seconds', endpoint='device'):
+        ...
+    metrics.inc('nest_errors_total', kind='timeout')
+"""
+
+import bisect
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, math.inf)
+
+ENABLED = False
+
+class Histogram():
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self) -> None:
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket it falls in"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+class Registry():
+    def __init__(self) -> None:
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, labels=()):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, labels in self.counters}):
+                lines.append('# TYPE {} counter'.format(name))
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append('{}{} {}'.format(name, _labels(labels), value))
+            for name in sorted({name for name, labels in self.histograms}):
+                lines.append('# TYPE {} histogram'.format(name))
+                for (histogram_name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == math.inf else repr(bound)
+                        lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', le),)), cumulative))
+                    lines.append('{}_sum{} {}'.format(name, _labels(labels), histogram.sum))
+                    lines.append('{}_count{} {}'.format(name, _labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self, conn, timestamp=None):
+        """Write the current counters and histogram summaries to the metrics table"""
+        timestamp = int(timestamp if timestamp is not None else time.time())
+        rows = []
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                rows.append((timestamp, name, _labels(labels), value))
+            for (name, labels), histogram in self.histograms.items():
+                rows.append((timestamp, name + '_count', _labels(labels), histogram.count))
+                rows.append((timestamp, name + '_sum', _labels(labels), histogram.sum))
+                rows.append((timestamp, name + '_p50', _labels(labels), histogram.quantile(0.5)))
+                rows.append((timestamp, name + '_p95', _labels(labels), histogram.quantile(0.95)))
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?)', rows)
+        return len(rows)
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value) for key, value in labels) + '}'
+
+REGISTRY = Registry()
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+def inc(name, value=1, **labels):
+    """Add to a counter"""
+    if ENABLED:
+        REGISTRY.inc(name, value, tuple(sorted(labels.items())))
+
+def observe(name, value, **labels):
+    """Record a value, in seconds, in a histogram"""
+    if ENABLED:
+        REGISTRY.observe(name, value, tuple(sorted(labels.items())))
+
+class _Timer():
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels) -> None:
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        REGISTRY.observe(self.name, time.perf_counter() - self.start, self.labels)
+        if exc_type is not None:
+            REGISTRY.inc(self.name.replace('_seconds', '') + '_errors_total', 1, self.labels)
+
+class _NoTimer():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        pass
+
+NO_TIMER = _NoTimer()
+
+def timer(name, **labels):
+    """Time a block into a histogram; exceptions also count towards <name without _seconds>_errors_total"""
+    if not ENABLED:
+        return NO_TIMER
+    return _Timer(name, tuple(sorted(labels.items())))
+
+def create_table(conn):
+    """Create the table metric snapshots are written to"""
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS metrics
+                        (timestamp INTEGER NOT NULL, name TEXT NOT NULL, labels TEXT NOT NULL, value REAL,
+                         PRIMARY KEY (timestamp, name, labels)) WITHOUT ROWID''')
+
+def snapshot(conn):
+    return REGISTRY.snapshot(conn)
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        data = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def serve(port, host='127.0.0.1'):
+    """Serve /metrics from a background thread. Returns the server."""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='Metrics', daemon=True).start()
+    return server
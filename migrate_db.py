@@ -0,0 +1,79 @@
+"""Convert an existing homelog.db from the original device_stats layout to the indexed schema in schema.py.
+
+    python migrate_db.py [homelog.db]
+
+The old table is renamed to device_stats_old and copied over in chunks, one transaction per chunk,
+so memory use stays flat however large the table is. Rows are inserted with INSERT OR IGNORE, so
+an interrupted migration can simply be run again. The old table is dropped and the file vacuumed
+once every row has been copied. Any rollups are cleared, and the logger rebuilds them from the
+migrated table when it next starts.
+"""
+
+import sqlite3
+import sys
+
+import schema
+
+DB_FILE = 'homelog.db'
+CHUNK_SIZE = 10000
+
+def migrate(conn, chunk_size=CHUNK_SIZE):
+    """Migrate device_stats in place. Returns the number of rows copied."""
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    if 'device_stats_old' not in tables:
+        if not schema.is_legacy(conn):
+            print("device_stats is already up to date")
+            return 0
+        with conn:
+            # Renaming would carry these over to the old table, and create_tables would then skip them
+            conn.execute('DROP INDEX IF EXISTS device_stats_timestamp')
+            conn.execute('DROP VIEW IF EXISTS device_readings')
+            conn.execute('ALTER TABLE device_stats RENAME TO device_stats_old')
+    schema.create_tables(conn)
+    encoder = schema.Encoder(conn)
+
+    total = conn.execute('SELECT count(*) FROM device_stats_old').fetchone()[0]
+    copied = 0
+    skipped = 0
+    # Page through the old table by rowid so each chunk is a cheap range scan
+    last_rowid = -1
+    while True:
+        rows = conn.execute('SELECT rowid, timestamp, temperature, relative_humidity, dew_point, device_id, connectivity, '
+                            'hvac, mode, eco_mode, eco_heat, eco_cool, set_point FROM device_stats_old '
+                            'WHERE rowid > ? ORDER BY rowid LIMIT ?', (last_rowid, chunk_size)).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+        encoded = []
+        with conn:
+            for row in rows:
+                if row[1] is None or row[5] is None:
+                    skipped += 1
+                    continue
+                encoded.append(encoder.encode(row[1:]))
+            conn.executemany(schema.INSERT_SQL, encoded)
+        copied += len(encoded)
+        print("Copied {} of {} rows".format(copied, total), end='\r')
+    print()
+
+    migrated = conn.execute('SELECT count(*) FROM device_stats').fetchone()[0]
+    if migrated + skipped < total:
+        print("{} duplicate (device_id, timestamp) rows were dropped".format(total - migrated - skipped))
+    if skipped:
+        print("{} rows without a timestamp or device were dropped".format(skipped))
+    with conn:
+        conn.execute('DROP TABLE device_stats_old')
+        # Rollups of the old table are keyed by text device ids; they are rebuilt from the new one
+        for table in ('rollup_hourly', 'rollup_daily', 'rollup_state'):
+            if table in tables:
+                conn.execute('DELETE FROM ' + table)
+    # The VACUUM that reclaims the old table also switches the file to incremental auto-vacuum
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    return copied
+
+if __name__ == '__main__':
+    db_file = sys.argv[1] if len(sys.argv) > 1 else DB_FILE
+    conn = sqlite3.connect(db_file)
+    migrate(conn)
+    conn.close()
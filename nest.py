@@ -4,20 +4,45 @@ https://console.nest.google.com/device-access/project-list
 
 """
 
+import concurrent.futures
 import datetime
 import json
+import operator
 import os
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import schema
 
 CONFIG_FILE = 'nest_api_config.json'
+API_URL = 'https://smartdevicemanagement.googleapis.com/v1/'
+TOKEN_URL = 'https://www.googleapis.com/oauth2/v4/token'
+REQUEST_TIMEOUT = 10    # seconds per API request
+MAX_WORKERS = 8         # devices fetched in parallel
+DEVICES_TTL = 3600      # seconds to reuse the device list before listing again
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)    # refresh this long before the token expires
 
 def c_to_f(temperature):
     """Convert Celsius to Fahrenheit"""
     return round((temperature * 9/5) + 32)
 
 class Nest_Api():
-    def __init__(self, config_file) -> None:
+    def __init__(self, config_file, timeout=REQUEST_TIMEOUT, devices_ttl=DEVICES_TTL, refresh_margin=TOKEN_REFRESH_MARGIN,
+                 api_url=API_URL, token_url=TOKEN_URL) -> None:
         self.config_file = config_file
+        self.api_url = api_url
+        self.token_url = token_url
+        self.timeout = timeout
+        self.session = new_session()
+        self.devices_ttl = devices_ttl
+        self.devices = None
+        self.devices_fetched = 0
+        self.refresh_margin = refresh_margin
+        self.token_lock = threading.Lock()
+        self.token_refresher = None
         if os.path.exists(config_file):
             self.load_config()
         else:
@@ -35,9 +60,8 @@ class Nest_Api():
         self.refresh_token = self.config['refresh_token']
         self.access_token = self.config['access_token']
         self.access_token_expiration = datetime.datetime.fromisoformat(self.config['access_token_expiration'])
-        # If access token has expired, refresh it
-        if datetime.datetime.now() > self.access_token_expiration:
-            self.refresh_access_token()
+        # If access token has expired or is about to, refresh it
+        self.ensure_token()
             
     def save_config(self):
         """Save config to JSON file."""
@@ -92,6 +116,7 @@ class Nest_Api():
 
     def auth_headers(self):
         """Return headers for API calls."""
+        self.ensure_token()
         return {
             'Content-Type': 'application/json',
             'Authorization': self.access_token,
@@ -107,7 +132,7 @@ class Nest_Api():
             ('redirect_uri', self.redirect_uri),
         )
 
-        response = requests.post('https://www.googleapis.com/oauth2/v4/token', params=params)
+        response = self.session.post(self.token_url, params=params, timeout=self.timeout)
 
         response_json = response.json()
         self.access_token = response_json['token_type'] + ' ' + str(response_json['access_token'])
@@ -115,6 +140,44 @@ class Nest_Api():
         self.access_token_expiration = datetime.datetime.now() + datetime.timedelta(seconds=response_json['expires_in'])
         self.save_config()
 
+    def token_expires_soon(self):
+        """Return True if the access token expires within the refresh margin."""
+        return datetime.datetime.now() + self.refresh_margin >= self.access_token_expiration
+
+    def ensure_token(self):
+        """Refresh the access token if it expires within the refresh margin."""
+        if not self.token_expires_soon():
+            return
+        with self.token_lock:
+            # Another thread may have refreshed while we waited for the lock
+            if self.token_expires_soon():
+                self.refresh_access_token()
+
+    def invalidate_token(self):
+        """Force a refresh before the next API call, e.g. after the API rejected the token."""
+        with self.token_lock:
+            self.access_token_expiration = datetime.datetime.now()
+
+    def start_token_refresher(self):
+        """Refresh the access token in the background ahead of its expiration.
+
+        Keeps the token fresh between polls so the polling path never waits on an auth round-trip.
+        """
+        if self.token_refresher is not None:
+            return
+        self.token_refresher = threading.Thread(target=self._refresh_loop, name='TokenRefresher', daemon=True)
+        self.token_refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            refresh_at = self.access_token_expiration - self.refresh_margin
+            time.sleep(max((refresh_at - datetime.datetime.now()).total_seconds(), 0))
+            try:
+                self.ensure_token()
+            except Exception as e:
+                print("Error refreshing access token:", e)
+                time.sleep(60)
+
     def refresh_access_token(self):
         """Use a valid refresh token to poll API for a new access token."""
         params = (
@@ -124,7 +187,9 @@ class Nest_Api():
             ('grant_type', 'refresh_token'),
         )
 
-        response = requests.post('https://www.googleapis.com/oauth2/v4/token', params=params)
+        metrics.inc('nest_api_calls_total', endpoint='token')
+        with metrics.timer('nest_request_seconds', endpoint='token'):
+            response = self.session.post(self.token_url, params=params, timeout=self.timeout)
 
         response_json = response.json()
         self.access_token = response_json['token_type'] + ' ' + response_json['access_token']
@@ -133,59 +198,191 @@ class Nest_Api():
             
     def get_structures(self):
         """Poll API for structure data (home, etc.)"""
-        url_structures = 'https://smartdevicemanagement.googleapis.com/v1/enterprises/' + self.project_id + '/structures'
-        response = requests.get(url_structures, headers=self.auth_headers())
+        url_structures = self.api_url + 'enterprises/' + self.project_id + '/structures'
+        response = self.session.get(url_structures, headers=self.auth_headers(), timeout=self.timeout)
         return response.json()
     
-    def get_devices(self):
-        url_get_devices = 'https://smartdevicemanagement.googleapis.com/v1/enterprises/' + self.project_id + '/devices'
-        response = requests.get(url_get_devices, headers=self.auth_headers())
-        devices = []
-        try:
-            for device in response.json()['devices']:
-                devices.append(device)
-        except KeyError:
+    def get_devices(self, refresh=False):
+        """Return the device list, polling the API only if the cached list is older than devices_ttl."""
+        if not refresh and self.devices is not None and time.monotonic() - self.devices_fetched < self.devices_ttl:
+            return self.devices
+        devices = self.list_devices()
+        if devices is None:
+            # No devices usually means the token was rejected; refresh it and try once more
+            self.invalidate_token()
+            devices = self.list_devices()
+        if devices is None:
             #print("Error: No devices found.")
-            self.refresh_access_token()
-            self.get_devices()
+            return []
+        self.devices = devices
+        self.devices_fetched = time.monotonic()
         return devices
 
+    def list_devices(self):
+        """Poll API for the device list. Returns None if the response has no devices."""
+        url_get_devices = self.api_url + 'enterprises/' + self.project_id + '/devices'
+        headers = self.auth_headers()
+        metrics.inc('nest_api_calls_total', endpoint='devices')
+        with metrics.timer('nest_request_seconds', endpoint='devices'):
+            response = self.session.get(url_get_devices, headers=headers, timeout=self.timeout)
+        try:
+            return list(response.json()['devices'])
+        except KeyError:
+            return None
+
+    def invalidate_devices(self):
+        """Drop the cached device list so the next get_devices call polls the API."""
+        self.devices = None
+
+def new_session(pool_size=MAX_WORKERS):
+    """Create a requests session that keeps connections to the API open between polls"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 def get_device_stats(device, api):
     """Poll API for device stats (temperature, humidity, etc.)"""
-    url_get_device = 'https://smartdevicemanagement.googleapis.com/v1/' + device['name']
-    response = requests.get(url_get_device, headers=api.auth_headers())    
+    url_get_device = api.api_url + device['name']
+    headers = api.auth_headers()
+    metrics.inc('nest_api_calls_total', endpoint='device')
+    with metrics.timer('nest_request_seconds', endpoint='device'):
+        response = api.session.get(url_get_device, headers=headers, timeout=api.timeout)
+        response.raise_for_status()
     device_stats = response.json()
     return device_stats
 
+def get_all_device_stats(devices, api, max_workers=MAX_WORKERS):
+    """Poll API for the stats of all devices in parallel.
+
+    Returns a list of (device, device_stats) in device order. Devices that fail or do not answer
+    within the API timeout are left out so they cannot hold up the rest of the poll.
+    """
+    if not devices:
+        return []
+    start = time.perf_counter()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(devices)))
+    futures = [executor.submit(get_device_stats, device, api) for device in devices]
+    # requests' timeout applies per socket operation, so also bound the poll as a whole
+    concurrent.futures.wait(futures, timeout=api.timeout * 2)
+    executor.shutdown(wait=False, cancel_futures=True)
+    results = []
+    for device, future in zip(devices, futures):
+        if not future.done():
+            print("Timed out polling device:", device['name'])
+            metrics.inc('nest_device_errors_total', kind='timeout')
+            continue
+        try:
+            results.append((device, future.result()))
+        except requests.HTTPError as e:
+            print("Error polling device:", device['name'], e)
+            metrics.inc('nest_device_errors_total', kind='http_{}'.format(e.response.status_code))
+            if e.response.status_code == 401:
+                api.invalidate_token()
+            elif e.response.status_code == 404:
+                # The device is gone; list devices again next cycle
+                api.invalidate_devices()
+        except Exception as e:
+            print("Error polling device:", device['name'], e)
+            metrics.inc('nest_device_errors_total', kind=type(e).__name__)
+    metrics.observe('nest_poll_seconds', time.perf_counter() - start)
+    return results
+
+# Reading fields decoded from a device response: (field, trait, key, Celsius value converted to °F).
+# Every trait is optional; a field whose trait is missing from the response is None.
+TRAIT_FIELDS = (
+    ('temperature', 'sdm.devices.traits.Temperature', 'ambientTemperatureCelsius', True),
+    ('relative_humidity', 'sdm.devices.traits.Humidity', 'ambientHumidityPercent', False),
+    ('connectivity', 'sdm.devices.traits.Connectivity', 'status', False),
+    ('hvac', 'sdm.devices.traits.ThermostatHvac', 'status', False),
+    ('mode', 'sdm.devices.traits.ThermostatMode', 'mode', False),
+    ('eco_mode', 'sdm.devices.traits.ThermostatEco', 'mode', False),
+    ('eco_heat', 'sdm.devices.traits.ThermostatEco', 'heatCelsius', True),
+    ('eco_cool', 'sdm.devices.traits.ThermostatEco', 'coolCelsius', True),
+    ('set_point', 'sdm.devices.traits.ThermostatTemperatureSetpoint', 'heatCelsius', True),
+    ('set_point_cool', 'sdm.devices.traits.ThermostatTemperatureSetpoint', 'coolCelsius', True),
+)
+
+def dew_point_c(temperature, relative_humidity):
+    """Approximate dew point in Celsius; only reasonable above 50% relative humidity, so None below that"""
+    if temperature is None or relative_humidity is None or relative_humidity < 50:
+        return None
+    return temperature - ((100 - relative_humidity) / 5)
+
+def _decode_traits(device_stats):
+    """Return the TRAIT_FIELDS values of a device response in order, plus the Celsius temperature"""
+    traits = device_stats.get('traits', {})
+    values = []
+    for field, trait, key, celsius in TRAIT_FIELDS:
+        value = traits.get(trait, {}).get(key)
+        if celsius and value is not None:
+            value = c_to_f(value)
+        values.append(value)
+    return values, traits.get('sdm.devices.traits.Temperature', {}).get('ambientTemperatureCelsius')
+
+# Fields of a Reading in constructor order: the ones not taken from traits, then TRAIT_FIELDS
+READING_FIELDS = ('timestamp', 'device_id', 'dew_point') + tuple(field for field, trait, key, celsius in TRAIT_FIELDS)
+HUMIDITY = READING_FIELDS.index('relative_humidity')
+DEW_POINT = READING_FIELDS.index('dew_point')
+
+# Picks a device_stats row in schema.READING_COLUMNS order out of a list of READING_FIELDS values
+_as_row = operator.itemgetter(*(READING_FIELDS.index(column) for column in schema.READING_COLUMNS))
+
+def _decode(device_stats, timestamp):
+    """Return the READING_FIELDS values of a device response"""
+    values, temperature_c = _decode_traits(device_stats)
+    record = [timestamp, device_stats['name'].split('/')[-1], None] + values
+    dew_point = dew_point_c(temperature_c, record[HUMIDITY])
+    if dew_point is not None:
+        record[DEW_POINT] = c_to_f(dew_point)
+    return record
+
+class Reading():
+    """One decoded device response. Temperatures are in °F."""
+    __slots__ = READING_FIELDS
+
+    def __init__(self, *values) -> None:
+        if len(values) != len(READING_FIELDS):
+            raise TypeError("Reading takes {} values, got {}".format(len(READING_FIELDS), len(values)))
+        for field, value in zip(READING_FIELDS, values):
+            setattr(self, field, value)
+
+    def as_row(self):
+        """Return the reading as a device_stats row in schema.READING_COLUMNS order"""
+        return tuple(getattr(self, column) for column in schema.READING_COLUMNS)
+
+def decode_device(device_stats, timestamp):
+    """Decode a device response into a Reading"""
+    return Reading(*_decode(device_stats, timestamp))
+
+def decode_rows(responses, timestamp):
+    """Decode a batch of device responses straight into device_stats rows"""
+    return [_as_row(_decode(device_stats, timestamp)) for device_stats in responses]
+
 def print_device_stats(device_stats):
-    temperature = device_stats['traits']['sdm.devices.traits.Temperature']['ambientTemperatureCelsius']
-    relative_humidity = device_stats['traits']['sdm.devices.traits.Humidity']['ambientHumidityPercent']
-    print('\nTemperature:\t', c_to_f(temperature), "°F")
-    print('\nHumidity:\t', relative_humidity, "%")
-    if relative_humidity >= 50:
-        dew_point = temperature - ((100 - relative_humidity) / 5)
-        print('Dew Point:\t', c_to_f(dew_point), "°F")
-    else:
-        dew_point = None
-    print('\nConnectivity:\t', device_stats['traits']['sdm.devices.traits.Connectivity']['status'])
-    print('HVAC:\t\t', device_stats['traits']['sdm.devices.traits.ThermostatHvac']['status'])
-    print('Mode:\t\t', device_stats['traits']['sdm.devices.traits.ThermostatMode']['mode'])
-    print('\nEco Mode:\t', device_stats['traits']['sdm.devices.traits.ThermostatEco']['mode'])
-    print('Eco Min:\t', c_to_f(device_stats['traits']['sdm.devices.traits.ThermostatEco']['heatCelsius']), "°F")
-    print('Eco Max:\t', c_to_f(device_stats['traits']['sdm.devices.traits.ThermostatEco']['coolCelsius']), "°F")
-    try:
-        print('Set Point:', c_to_f(device_stats['traits']['sdm.devices.traits.ThermostatTemperatureSetpoint']['heatCelsius']), "°F")
-    except KeyError:
-        pass
+    reading = device_stats if isinstance(device_stats, Reading) else decode_device(device_stats, None)
+    print('\nTemperature:\t', reading.temperature, "°F")
+    print('\nHumidity:\t', reading.relative_humidity, "%")
+    if reading.dew_point is not None:
+        print('Dew Point:\t', reading.dew_point, "°F")
+    print('\nConnectivity:\t', reading.connectivity)
+    print('HVAC:\t\t', reading.hvac)
+    print('Mode:\t\t', reading.mode)
+    print('\nEco Mode:\t', reading.eco_mode)
+    print('Eco Min:\t', reading.eco_heat, "°F")
+    print('Eco Max:\t', reading.eco_cool, "°F")
+    if reading.set_point is not None:
+        print('Set Point:', reading.set_point, "°F")
+    if reading.set_point_cool is not None:
+        print('Cool Set Point:', reading.set_point_cool, "°F")
     print('\n')
     
 
 if __name__ == '__main__':
     api = Nest_Api(CONFIG_FILE)
     devices = api.get_devices()
-    device_stats = []
-    for device in devices:
+    for device, device_stats in get_all_device_stats(devices, api):
         print('\nTimestamp:\t', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        device_stats.append(get_device_stats(device, api))
-        print_device_stats(device_stats[-1])
+        print_device_stats(device_stats)
     
\ No newline at end of file
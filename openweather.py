@@ -1,9 +1,16 @@
+import bisect
 import datetime
 import json
 
+import numpy as np
 import requests
 from decouple import config
 
+import metrics
+
+REQUEST_TIMEOUT = 10    # seconds
+ONECALL_URL = 'https://api.openweathermap.org/data/3.0/onecall'
+
 # Cardinal directions and their corresponding degrees
 CARDINAL_DIRECTIONS = [
     {'name': 'north', 'abbr': 'N', 'min': 348.75, 'max': 360},
@@ -52,39 +59,82 @@ MOON_PHASES = [
     {'name': 'new moon', 'min': 0.9375, 'max': 1.0}   
 ]
 
+class Classifier():
+    """Look up which [min, max) range of a table a value falls in, by bisecting the range starts.
+
+    Works on a scalar or on a NumPy array (returning an object array of labels). Values outside
+    every range, including NaN, get the default label.
+    """
+    def __init__(self, ranges, label, default) -> None:
+        ranges = sorted(ranges, key=lambda entry: entry['min'])
+        for previous, entry in zip(ranges, ranges[1:]):
+            if previous['max'] != entry['min']:
+                raise ValueError("Ranges must be contiguous")
+        self.mins = [entry['min'] for entry in ranges]
+        self.max = ranges[-1]['max']
+        self.labels = [entry[label] for entry in ranges]
+        self.default = default
+        self.mins_array = np.array(self.mins, dtype='f8')
+        self.labels_array = np.array(self.labels + [default], dtype=object)
+
+    def __call__(self, value):
+        if isinstance(value, np.ndarray):
+            return self.classify_array(value)
+        if not self.mins[0] <= value < self.max:
+            return self.default
+        return self.labels[bisect.bisect_right(self.mins, value) - 1]
+
+    def indices(self, values):
+        """Return the index of each value's range, or len(ranges) for values outside every range"""
+        values = np.asarray(values, dtype='f8')
+        index = np.searchsorted(self.mins_array, values, side='right') - 1
+        inside = (values >= self.mins[0]) & (values < self.max)
+        return np.where(inside, index, len(self.labels))
+
+    def classify_array(self, values):
+        return self.labels_array[self.indices(values)]
+
+CARDINAL_ABBR = Classifier(CARDINAL_DIRECTIONS, 'abbr', 'nowhere')
+CARDINAL_NAME = Classifier(CARDINAL_DIRECTIONS, 'name', 'nowhere')
+VISIBILITY = Classifier(DISTANCE_STRINGS, 'desc', 'unclear at this time')
+MOON_PHASE = Classifier(MOON_PHASES, 'name', 'a mystery')
+
 # Function to convert degrees to cardinal directions
 def degrees_to_cardinal(degrees, long=False):
-    for direction in CARDINAL_DIRECTIONS:
-        if direction['min'] <= degrees < direction['max']:
-            if long == True:
-                return direction['name']
-            return direction['abbr']
-    return 'nowhere'
+    if long == True:
+        return CARDINAL_NAME(degrees)
+    return CARDINAL_ABBR(degrees)
 
 # Function to convert visibility in feet to a string
 def visibility_to_string(feet):
-    for distance in DISTANCE_STRINGS:
-        if distance['min'] <= feet < distance['max']:
-            if callable(distance['desc']):
-                return distance['desc'](feet)
-            else:
-                return distance['desc']
-    return 'unclear at this time'
+    if isinstance(feet, np.ndarray):
+        index = VISIBILITY.indices(feet)
+        result = VISIBILITY.labels_array[index]
+        # Descriptions that are functions of the distance are computed for the whole array at once
+        for i, desc in enumerate(VISIBILITY.labels):
+            if callable(desc):
+                selected = index == i
+                miles = np.round(np.asarray(feet, dtype='f8')[selected] / 5280).astype(np.int64)
+                result[selected] = [str(mile) + ' miles' for mile in miles.tolist()]
+        return result
+    desc = VISIBILITY(feet)
+    if callable(desc):
+        return desc(feet)
+    return desc
 
 # Function to convert moon phase value to a string
 def moon_phase_string(moon_phase):
-    for phase in MOON_PHASES:
-        if phase['min'] <= moon_phase < phase['max']:
-            return phase['name']
-    return 'a mystery'
+    return MOON_PHASE(moon_phase)
     
 # Function to convert unix time to a nice string format
 def nice_time(unix_time):
     return datetime.datetime.fromtimestamp(unix_time).strftime('%_I:%M %p')
     
-def get_weather_data(lat, lon, units, api_key):
-    request_url = 'https://api.openweathermap.org/data/3.0/onecall?lat={}&lon={}&units={}&appid={}'.format(lat, lon, units, api_key)
-    response = requests.get(request_url)
+def get_weather_data(lat, lon, units, api_key, timeout=REQUEST_TIMEOUT, url=ONECALL_URL):
+    request_url = url + '?lat={}&lon={}&units={}&appid={}'.format(lat, lon, units, api_key)
+    metrics.inc('openweather_api_calls_total')
+    with metrics.timer('openweather_request_seconds'):
+        response = requests.get(request_url, timeout=timeout)
     return response.json()
 
 def write_to_file(data, filename):
@@ -134,28 +184,64 @@ def print_current_weather(current_weather):
     print("Sunrise:     " + str(current_weather['sunrise']).strip())
     print("Sunset:      " + str(current_weather['sunset']).strip())
 
+# Column types of decoded forecasts
+HOURLY_DTYPE = np.dtype([
+    ('dt', 'i8'), ('temp', 'f8'), ('humidity', 'f8'), ('dew_point', 'f8'),
+    ('wind_speed', 'f8'), ('wind_deg', 'f8'), ('pop', 'f8'), ('weather_id', 'i4'), ('description', 'O')
+])
+DAILY_DTYPE = np.dtype([
+    ('dt', 'i8'), ('temp_min', 'f8'), ('temp_max', 'f8'), ('humidity', 'f8'), ('dew_point', 'f8'), ('pop', 'f8'),
+    ('sunrise', 'i8'), ('sunset', 'i8'), ('moonrise', 'i8'), ('moonset', 'i8'), ('moon_phase', 'f8'),
+    ('weather_id', 'i4'), ('description', 'O'), ('summary', 'O')
+])
+
+def _weather(entry):
+    """Return the condition id and description of a forecast entry"""
+    weather = entry['weather'][0]
+    return weather['id'], weather['description']
+
+def decode_hourly(response):
+    """Decode the hourly forecast into a structured array of HOURLY_DTYPE"""
+    return np.fromiter(((hour['dt'], hour['temp'], hour['humidity'], hour['dew_point'], hour['wind_speed'],
+                         hour['wind_deg'], hour['pop'], *_weather(hour)) for hour in response['hourly']),
+                       dtype=HOURLY_DTYPE, count=len(response['hourly']))
+
+def decode_daily(response):
+    """Decode the daily forecast into a structured array of DAILY_DTYPE"""
+    return np.fromiter(((day['dt'], day['temp']['min'], day['temp']['max'], day['humidity'], day['dew_point'], day['pop'],
+                         day['sunrise'], day['sunset'], day['moonrise'], day['moonset'], day['moon_phase'],
+                         *_weather(day), day['summary']) for day in response['daily']),
+                       dtype=DAILY_DTYPE, count=len(response['daily']))
+
+def decode_many(responses, decode=decode_hourly):
+    """Decode a sequence of archived responses into one array"""
+    return np.concatenate([decode(response) for response in responses])
+
+def _rounded(column):
+    # np.round rounds half to even, like round(), so the strings match the per-value formatting
+    return np.round(column).astype(np.int64).tolist()
+
+def format_hourly(hourly):
+    """Yield display strings for each hour of a decoded hourly forecast"""
+    temps, humidities, dew_points = _rounded(hourly['temp']), _rounded(hourly['humidity']), _rounded(hourly['dew_point'])
+    wind_speeds, pops = _rounded(hourly['wind_speed']), _rounded(hourly['pop'])
+    directions = degrees_to_cardinal(hourly['wind_deg']).tolist()
+    descriptions = hourly['description'].tolist()
+    for i, dt in enumerate(hourly['dt'].tolist()):
+        when = datetime.datetime.fromtimestamp(dt)
+        yield {
+            'weekday': when.strftime('%a'),
+            'hr': when.strftime('%_I %p').lower(),
+            'temp': str(temps[i]) + "°F",
+            'humidity': str(humidities[i]) + "% ",
+            'dew_point': str(dew_points[i]) + "°F",
+            'wind': str(wind_speeds[i]) + " MPH" + "\t" + directions[i],
+            'pop': str(pops[i]) + "%",
+            'weather': descriptions[i]
+        }
+
 def get_hourly_forecast(response):
-    hourly_forecast = []
-    for hour in response['hourly']:
-        weekday   = datetime.datetime.fromtimestamp(hour['dt']).strftime('%a')
-        hr      = datetime.datetime.fromtimestamp(hour['dt']).strftime('%_I %p').lower()
-        temp      = str(round(hour['temp'])) + "°F"
-        humidity  = str(round(hour['humidity'])) + "% "
-        dew_point = str(round(hour['dew_point'])) + "°F"
-        wind      = str(round(hour['wind_speed'])) + " MPH" + "\t" + degrees_to_cardinal(hour['wind_deg'], long=False)
-        pop       = str(round(hour['pop'])) + "%"
-        weather   = hour['weather'][0]['description']
-        hourly_forecast.append({
-            'weekday': weekday,
-            'hr': hr,
-            'temp': temp,
-            'humidity': humidity,
-            'dew_point': dew_point,
-            'wind': wind,
-            'pop': pop,
-            'weather': weather
-        })
-    return hourly_forecast
+    return list(format_hourly(decode_hourly(response)))
 
 def print_hourly_forecast(hourly_forecast):
     print("\nFORECAST")
@@ -163,44 +249,35 @@ def print_hourly_forecast(hourly_forecast):
     for hour in hourly_forecast:
         print(hour['weekday'] + '  ' + hour['hr'] + '  ' + hour['temp'] + '\t' + hour['humidity'] + '  ' + hour['dew_point'] + '\t' + hour['wind'] + '\t' + hour['pop'] + '\t' + hour['weather'])
 
-def get_daily_forecast(response):
-    daily_forecast = []
-    i = 0
-    for day in response['daily']:
+def format_daily(daily):
+    """Yield display strings for each day of a decoded daily forecast"""
+    highs, lows, rhs = _rounded(daily['temp_max']), _rounded(daily['temp_min']), _rounded(daily['humidity'])
+    dew_points, pops = _rounded(daily['dew_point']), _rounded(daily['pop'])
+    summaries, moon_phases = daily['summary'].tolist(), daily['moon_phase'].tolist()
+    sunrises, sunsets = daily['sunrise'].tolist(), daily['sunset'].tolist()
+    moonrises, moonsets = daily['moonrise'].tolist(), daily['moonset'].tolist()
+    for i, dt in enumerate(daily['dt'].tolist()):
         if i == 0:
             weekday = "TODAY"
         else:
-            weekday = datetime.datetime.fromtimestamp(day['dt']).strftime('%A').upper()
-        i += 1
-
-        summary   = day['summary']
-        high      = str(round(day['temp']['max']))
-        low       = str(round(day['temp']['min']))
-        rh        = str(round(day['humidity']))
-        dew_point = str(round(day['dew_point']))
-        pop       = str(round(day['pop']))
-
-        sunrise    = nice_time(day['sunrise'])
-        sunset     = nice_time(day['sunset'])
-        moonrise   = nice_time(day['moonrise'])
-        moonset    = nice_time(day['moonset'])
-        moon_phase = moon_phase_string(day['moon_phase'])
-
-        daily_forecast.append({
+            weekday = datetime.datetime.fromtimestamp(dt).strftime('%A').upper()
+        yield {
             'weekday': weekday,
-            'summary': summary,
-            'high': high,
-            'low': low,
-            'rh': rh,
-            'dew_point': dew_point,
-            'pop': pop,
-            'sunrise': sunrise,
-            'sunset': sunset,
-            'moonrise': moonrise,
-            'moonset': moonset,
-            'moon_phase': moon_phase
-        })
-    return daily_forecast
+            'summary': summaries[i],
+            'high': str(highs[i]),
+            'low': str(lows[i]),
+            'rh': str(rhs[i]),
+            'dew_point': str(dew_points[i]),
+            'pop': str(pops[i]),
+            'sunrise': nice_time(sunrises[i]),
+            'sunset': nice_time(sunsets[i]),
+            'moonrise': nice_time(moonrises[i]),
+            'moonset': nice_time(moonsets[i]),
+            'moon_phase': moon_phase_string(moon_phases[i])
+        }
+
+def get_daily_forecast(response):
+    return list(format_daily(decode_daily(response)))
 
 def print_daily_forecast(daily_forecast):
     for day in daily_forecast:
@@ -0,0 +1,122 @@
+"""Retention for raw readings.
+
+Raw 5-minute rows are kept for a configurable number of days; older history lives on in the hourly
+and daily rollups. purge() deletes expired rows in small transactions, pausing between them, so the
+logger's writes are never blocked for long. Only rows the rollups already cover are deleted, and the
+cutoff is recorded as the raw horizon so rollup.rebuild() never recomputes buckets from the
+partial raw history before it.
+
+Freed pages are returned to the filesystem with incremental auto-vacuum rather than a full VACUUM,
+which would lock the database and rewrite the whole file. New databases are created with
+auto_vacuum=INCREMENTAL (see db_writer.PRAGMAS); convert an existing one once, while the logger is
+stopped, with
+
+    python retention.py homelog.db --convert
+"""
+
+import argparse
+import sqlite3
+import time
+
+import delta
+import rollup
+import schema
+
+DB_FILE = 'homelog.db'
+RETENTION_DAYS = 90         # days of raw readings to keep
+BATCH_SIZE = 5000           # rows deleted per transaction
+BATCH_PAUSE = 0.05          # seconds between transactions, to let the logger in
+VACUUM_PAGES = 1000         # pages released per incremental_vacuum step
+INTERVAL = rollup.DAY       # seconds between scheduled runs
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+DELETE_SQL = '''DELETE FROM device_stats WHERE (device_id, timestamp) IN
+                (SELECT device_id, timestamp FROM device_stats WHERE timestamp < ? ORDER BY timestamp LIMIT ?)'''
+
+def cutoff(conn, days, now=None):
+    """Return the timestamp before which raw rows may be deleted, or None if nothing is rolled up yet.
+
+    The cutoff falls on a UTC day boundary no later than the day of the rollup high-water mark.
+    """
+    last = rollup.high_water(conn)
+    if last is None:
+        return None
+    now = time.time() if now is None else now
+    limit = min(int(now) - days * rollup.DAY, last)
+    return limit - limit % rollup.DAY
+
+def purge(conn, days=RETENTION_DAYS, batch_size=BATCH_SIZE, pause=BATCH_PAUSE, now=None):
+    """Delete raw readings older than days, batch_size rows per transaction. Returns the number deleted."""
+    limit = cutoff(conn, days, now)
+    if limit is None:
+        return 0
+    horizon = rollup.raw_horizon(conn)
+    if horizon is not None and horizon >= limit:
+        limit = horizon
+    else:
+        with conn:
+            rollup.set_raw_horizon(conn, limit)
+    deleted = 0
+    while True:
+        # total_changes also counts rows deleted by the delta-mode view's trigger, which rowcount does not
+        changes = conn.total_changes
+        with conn:
+            conn.execute(DELETE_SQL, (limit, batch_size))
+        count = conn.total_changes - changes
+        deleted += count
+        if count < batch_size:
+            break
+        time.sleep(pause)
+    if delta.is_delta(conn):
+        delta.prune(conn, limit)
+    return deleted
+
+def auto_vacuum(conn):
+    return conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+
+def reclaim(conn, pages=VACUUM_PAGES, pause=BATCH_PAUSE):
+    """Release free pages to the filesystem a few at a time. Returns the number of pages released."""
+    if auto_vacuum(conn) != AUTO_VACUUM_INCREMENTAL:
+        return 0
+    released = 0
+    while True:
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free:
+            return released
+        # Each step of the pragma releases one page; executescript steps it to completion
+        conn.executescript('PRAGMA incremental_vacuum({})'.format(min(free, pages)))
+        released += min(free, pages)
+        time.sleep(pause)
+
+def convert(conn):
+    """Switch an existing database to incremental auto-vacuum. Rewrites the file once with VACUUM."""
+    if auto_vacuum(conn) == AUTO_VACUUM_INCREMENTAL:
+        return False
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    return True
+
+def run(conn, days=RETENTION_DAYS):
+    """Purge expired readings and reclaim the space they used"""
+    deleted = purge(conn, days)
+    released = reclaim(conn)
+    print("Retention: deleted {} readings older than {} days, released {} pages".format(deleted, days, released))
+    return deleted, released
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delete expired raw readings and reclaim their space')
+    parser.add_argument('db', nargs='?', default=DB_FILE)
+    parser.add_argument('--days', type=int, default=RETENTION_DAYS, help='days of raw readings to keep (default: %(default)s)')
+    parser.add_argument('--convert', action='store_true', help='switch the database to incremental auto-vacuum first (runs VACUUM)')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    if schema.is_legacy(conn):
+        raise SystemExit("device_stats uses the old layout; run migrate_db.py first")
+    if args.convert and convert(conn):
+        print("Converted {} to incremental auto-vacuum".format(args.db))
+    rollup.create_tables(conn)
+    rollup.update(conn)
+    run(conn, args.days)
+    conn.close()
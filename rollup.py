@@ -0,0 +1,175 @@
+"""Hourly and daily aggregates of device_stats.
+
+rollup_hourly and rollup_daily hold, per device and bucket, the min, max, sum and sample count of
+temperature, relative humidity and dew point, so means can be merged across buckets. Buckets start
+on UTC hour and day boundaries.
+
+update() is called after each logger cycle. It recomputes the buckets from the high-water mark
+(the newest raw timestamp already rolled up) onward, so only the last partial hour and day are
+touched. Readings that arrive with a timestamp older than the high-water mark's hour (e.g. replayed
+from the spool) are not picked up by update(); include_late() or rebuild() recompute their buckets.
+
+Once retention.py has deleted old raw rows, the rollups are the only record of that history:
+rebuild() leaves buckets before the raw horizon alone, and query() reads hourly buckets instead of
+raw rows there.
+"""
+
+import sqlite3
+import sys
+
+import schema
+
+HOUR = 3600
+DAY = 86400
+RAW_INTERVAL = 300          # seconds between logged readings
+BACKFILL_WINDOW = 7 * DAY   # raw seconds aggregated per backfill transaction
+MAX_POINTS = 500            # default point budget for query()
+
+METRICS = ('temperature', 'relative_humidity', 'dew_point')
+
+# Resolutions from finest to coarsest: (name, bucket seconds)
+RESOLUTIONS = (('raw', RAW_INTERVAL), ('hourly', HOUR), ('daily', DAY))
+
+AGGREGATE_COLUMNS = tuple('{}_{}'.format(metric, part) for metric in METRICS for part in ('min', 'max', 'sum', 'n'))
+
+CREATE_ROLLUP = '''CREATE TABLE IF NOT EXISTS {} (device_id INTEGER NOT NULL, bucket INTEGER NOT NULL, samples INTEGER NOT NULL, {},
+                   PRIMARY KEY (device_id, bucket)) WITHOUT ROWID'''
+
+# Aggregates of raw rows, and of hourly buckets merged into days
+RAW_AGGREGATES = ', '.join('min({0}), max({0}), sum({0}), count({0})'.format(metric) for metric in METRICS)
+MERGE_AGGREGATES = ', '.join('min({0}_min), max({0}_max), sum({0}_sum), sum({0}_n)'.format(metric) for metric in METRICS)
+
+ROLLUP_HOURLY_SQL = '''INSERT OR REPLACE INTO rollup_hourly
+                       SELECT device_id, timestamp - timestamp % {}, count(*), {}
+                       FROM device_stats WHERE timestamp >= ? AND timestamp < ?
+                       GROUP BY 1, 2'''.format(HOUR, RAW_AGGREGATES)
+
+ROLLUP_DAILY_SQL = '''INSERT OR REPLACE INTO rollup_daily
+                      SELECT device_id, bucket - bucket % {}, sum(samples), {}
+                      FROM rollup_hourly WHERE bucket >= ? AND bucket < ?
+                      GROUP BY 1, 2'''.format(DAY, MERGE_AGGREGATES)
+
+def create_tables(conn):
+    """Create the rollup tables and their high-water mark"""
+    columns = ', '.join(column + (' INTEGER' if column.endswith('_n') else ' REAL') for column in AGGREGATE_COLUMNS)
+    with conn:
+        conn.execute(CREATE_ROLLUP.format('rollup_hourly', columns))
+        conn.execute(CREATE_ROLLUP.format('rollup_daily', columns))
+        conn.execute('CREATE TABLE IF NOT EXISTS rollup_state (name TEXT PRIMARY KEY, high_water INTEGER)')
+
+def high_water(conn):
+    """Return the newest raw timestamp included in the rollups, or None before the first run"""
+    row = conn.execute("SELECT high_water FROM rollup_state WHERE name = 'device_stats'").fetchone()
+    return row[0] if row else None
+
+def raw_horizon(conn):
+    """Return the timestamp before which raw rows have been deleted, or None if none have"""
+    row = conn.execute("SELECT high_water FROM rollup_state WHERE name = 'raw_horizon'").fetchone()
+    return row[0] if row else None
+
+def set_raw_horizon(conn, timestamp):
+    conn.execute("INSERT OR REPLACE INTO rollup_state VALUES ('raw_horizon', ?)", (timestamp,))
+
+def _set_high_water(conn, timestamp):
+    conn.execute("INSERT OR REPLACE INTO rollup_state VALUES ('device_stats', ?)", (timestamp,))
+
+def _rollup(conn, start, end):
+    """Recompute the hourly and daily buckets covering raw timestamps in [start, end)"""
+    hour_start = start - start % HOUR
+    day_start = start - start % DAY
+    conn.execute(ROLLUP_HOURLY_SQL, (hour_start, end))
+    conn.execute(ROLLUP_DAILY_SQL, (day_start, end))
+
+def update(conn):
+    """Bring the rollups up to date with device_stats. Returns the new high-water mark."""
+    last = high_water(conn)
+    if last is None:
+        return backfill(conn)
+    newest = conn.execute('SELECT max(timestamp) FROM device_stats').fetchone()[0]
+    if newest is None or newest <= last:
+        return last
+    with conn:
+        _rollup(conn, last, newest + 1)
+        _set_high_water(conn, newest)
+    return newest
+
+def rebuild(conn, start, end):
+    """Recompute the buckets covering [start, end), e.g. after late readings were inserted"""
+    start = start - start % DAY
+    end = end - end % DAY + DAY
+    horizon = raw_horizon(conn)
+    if horizon is not None:
+        # Buckets before the horizon (a UTC day boundary) can no longer be recomputed from raw rows
+        start = max(start, horizon)
+        if start >= end:
+            return
+    with conn:
+        conn.execute('DELETE FROM rollup_hourly WHERE bucket >= ? AND bucket < ?', (start, end))
+        conn.execute('DELETE FROM rollup_daily WHERE bucket >= ? AND bucket < ?', (start, end))
+        _rollup(conn, start, end)
+
+def include_late(conn, rows):
+    """Rebuild the buckets of any readings older than the high-water mark's hour"""
+    last = high_water(conn)
+    if last is None:
+        return
+    late = [row[0] for row in rows if row[0] < last - last % HOUR]
+    if late:
+        rebuild(conn, min(late), max(late) + 1)
+
+def backfill(conn, window=BACKFILL_WINDOW):
+    """Roll up all of device_stats, one window of raw history per transaction. Returns the high-water mark."""
+    oldest, newest = conn.execute('SELECT min(timestamp), max(timestamp) FROM device_stats').fetchone()
+    if oldest is None:
+        return None
+    # Windows start on day boundaries so each daily bucket is built from complete hours
+    window = max(window - window % DAY, DAY)
+    start = oldest - oldest % DAY
+    while start <= newest:
+        with conn:
+            _rollup(conn, start, start + window)
+        start += window
+    with conn:
+        _set_high_water(conn, newest)
+    return newest
+
+def choose_resolution(start, end, max_points=MAX_POINTS):
+    """Return the finest resolution that covers [start, end) in at most max_points buckets"""
+    for name, seconds in RESOLUTIONS:
+        if (end - start) / seconds <= max_points:
+            return name
+    return RESOLUTIONS[-1][0]
+
+def query(conn, device_id, start, end, max_points=MAX_POINTS, resolution=None):
+    """Return temperature, humidity and dew point for a device over [start, end).
+
+    Reads raw rows, hourly or daily buckets, whichever is the finest resolution that fits in
+    max_points. Each row is (bucket, samples, then min, max, mean for each of METRICS).
+    """
+    if resolution is None:
+        resolution = choose_resolution(start, end, max_points)
+        horizon = raw_horizon(conn)
+        if resolution == 'raw' and horizon is not None and start < horizon:
+            resolution = 'hourly'
+    row = conn.execute('SELECT id FROM device_lookup WHERE value = ?', (device_id,)).fetchone()
+    if row is None:
+        return []
+    if resolution == 'raw':
+        columns = ', '.join('{0}, {0}, {0}'.format(metric) for metric in METRICS)
+        sql = 'SELECT timestamp, 1, {} FROM device_stats WHERE device_id = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp'
+    else:
+        # Include the bucket that start falls in
+        start -= start % dict(RESOLUTIONS)[resolution]
+        columns = ', '.join('{0}_min, {0}_max, {0}_sum / {0}_n'.format(metric) for metric in METRICS)
+        sql = 'SELECT bucket, samples, {} FROM rollup_' + resolution + ' WHERE device_id = ? AND bucket >= ? AND bucket < ? ORDER BY bucket'
+    return conn.execute(sql.format(columns), (row[0], start, end)).fetchall()
+
+if __name__ == '__main__':
+    # Backfill or update the rollups of an existing database
+    conn = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else 'homelog.db')
+    if schema.is_legacy(conn):
+        raise SystemExit("device_stats uses the old layout; run migrate_db.py first")
+    schema.create_tables(conn)
+    create_tables(conn)
+    print("Rolled up to", update(conn))
+    conn.close()
@@ -0,0 +1,121 @@
+"""Run pollers on fixed wall-clock schedules.
+
+Each Source is polled at every multiple of its interval (plus an optional offset), e.g. a 300 second
+source runs at :00, :05, :10... regardless of how long each poll takes. Every source runs in its own
+thread, so a slow source never delays another. A poll that raises is retried with exponential
+backoff and jitter until the next tick is due; a poll that exceeds its timeout is abandoned, and
+ticks are skipped until it returns. Ticks that are missed are skipped, never run late in a burst.
+
+    scheduler = Scheduler()
+    scheduler.add(Source('nest', poll_nest, interval=300, timeout=60))
+    scheduler.add(Source('weather', poll_weather, interval=900, timeout=30))
+    scheduler.run()
+"""
+
+import concurrent.futures
+import random
+import threading
+import time
+
+def next_tick(now, interval, offset=0):
+    """Return the first time after now that is a multiple of interval past offset"""
+    return ((now - offset) // interval + 1) * interval + offset
+
+class Source():
+    """A pluggable poller: a callable and the schedule it runs on."""
+    def __init__(self, name, poll, interval, timeout=None, offset=0, backoff=5, max_backoff=60) -> None:
+        self.name = name
+        self.poll = poll
+        self.interval = interval
+        self.timeout = timeout if timeout is not None else interval / 2
+        self.offset = offset
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+
+    def retry_delay(self, attempt):
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(self.backoff * 2 ** attempt, self.max_backoff))
+
+class Scheduler():
+    def __init__(self, clock=time.time) -> None:
+        self.sources = []
+        self.clock = clock
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def add(self, source):
+        """Register a source. Sources added after run() has started are started immediately."""
+        self.sources.append(source)
+        if self.threads:
+            self._start(source)
+        return source
+
+    def _start(self, source):
+        thread = threading.Thread(target=self._run_source, args=(source,), name='Source-' + source.name, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def start(self):
+        """Start polling every source in the background"""
+        for source in self.sources:
+            self._start(source)
+
+    def run(self):
+        """Poll every source until stop() is called or the process is interrupted"""
+        self.start()
+        try:
+            while not self.stopped.wait(1):
+                pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _sleep_until(self, when):
+        """Wait until the given clock time. Returns False if the scheduler was stopped."""
+        return not self.stopped.wait(max(when - self.clock(), 0))
+
+    def _run_source(self, source):
+        # One worker per source; a hung poll keeps it busy and later ticks are skipped until it returns
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=source.name)
+        running = None
+        tick = next_tick(self.clock(), source.interval, source.offset)
+        while self._sleep_until(tick):
+            deadline = tick + source.interval
+            if running is not None and not running.done():
+                print("Skipping {}: previous poll still running".format(source.name))
+                source.skipped += 1
+            else:
+                attempt = 0
+                while True:
+                    running = executor.submit(source.poll)
+                    try:
+                        running.result(timeout=source.timeout)
+                        source.runs += 1
+                        break
+                    except concurrent.futures.TimeoutError:
+                        print("{} timed out after {} seconds".format(source.name, source.timeout))
+                        source.failures += 1
+                        break
+                    except Exception as e:
+                        source.failures += 1
+                        delay = source.retry_delay(attempt)
+                        attempt += 1
+                        if self.clock() + delay >= deadline:
+                            print("Error polling {}: {}; giving up until the next tick".format(source.name, e))
+                            break
+                        print("Error polling {}: {}; retrying in {:.0f} seconds".format(source.name, e, delay))
+                        if not self._sleep_until(self.clock() + delay):
+                            break
+            # Resume at the next boundary after now, skipping any ticks the poll overran
+            now = self.clock()
+            following = next_tick(now, source.interval, source.offset)
+            missed = int((following - deadline) // source.interval)
+            if missed > 0:
+                source.skipped += missed
+            tick = following
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,98 @@
+"""Database schema for homelog.db.
+
+device_stats is keyed on (device_id, timestamp) and stored WITHOUT ROWID. The categorical columns
+(device_id, connectivity, hvac, mode, eco_mode) hold integer codes that map to text in small
+<column>_lookup tables. The device_readings view decodes them back to the original column layout
+for ad-hoc queries.
+
+In delta storage mode (see delta.py) device_stats is a view with the same columns over change-only
+tables; everything here works the same against it.
+"""
+
+# Column order of a reading as produced by the logger and expected by Encoder.encode
+READING_COLUMNS = ('timestamp', 'temperature', 'relative_humidity', 'dew_point', 'device_id', 'connectivity',
+                   'hvac', 'mode', 'eco_mode', 'eco_heat', 'eco_cool', 'set_point')
+
+# Categorical columns and the lookup table each is encoded with
+LOOKUPS = {
+    'device_id': 'device_lookup',
+    'connectivity': 'connectivity_lookup',
+    'hvac': 'hvac_lookup',
+    'mode': 'mode_lookup',
+    'eco_mode': 'eco_mode_lookup',
+}
+
+# Column order of the device_stats table
+STATS_COLUMNS = ('device_id', 'timestamp', 'temperature', 'relative_humidity', 'dew_point', 'connectivity',
+                 'hvac', 'mode', 'eco_mode', 'eco_heat', 'eco_cool', 'set_point')
+
+CREATE_STATS = '''CREATE TABLE IF NOT EXISTS device_stats
+                  (device_id INTEGER NOT NULL, timestamp INTEGER NOT NULL,
+                   temperature REAL, relative_humidity REAL, dew_point REAL,
+                   connectivity INTEGER, hvac INTEGER, mode INTEGER, eco_mode INTEGER,
+                   eco_heat REAL, eco_cool REAL, set_point REAL,
+                   PRIMARY KEY (device_id, timestamp)) WITHOUT ROWID'''
+
+CREATE_LOOKUP = 'CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE)'
+
+CREATE_VIEW = '''CREATE VIEW IF NOT EXISTS device_readings AS
+                 SELECT s.timestamp, s.temperature, s.relative_humidity, s.dew_point, d.value AS device_id,
+                        c.value AS connectivity, h.value AS hvac, m.value AS mode, e.value AS eco_mode,
+                        s.eco_heat, s.eco_cool, s.set_point
+                 FROM device_stats s
+                 JOIN device_lookup d ON d.id = s.device_id
+                 LEFT JOIN connectivity_lookup c ON c.id = s.connectivity
+                 LEFT JOIN hvac_lookup h ON h.id = s.hvac
+                 LEFT JOIN mode_lookup m ON m.id = s.mode
+                 LEFT JOIN eco_mode_lookup e ON e.id = s.eco_mode'''
+
+# Duplicate (device_id, timestamp) readings are dropped rather than failing the whole batch
+INSERT_SQL = 'INSERT OR IGNORE INTO device_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+def create_tables(conn):
+    """Create the device_stats table, its lookup tables and the decoded view"""
+    with conn:
+        for table in LOOKUPS.values():
+            conn.execute(CREATE_LOOKUP.format(table))
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = 'device_stats'").fetchone() is None:
+            conn.execute(CREATE_STATS)
+            conn.execute('CREATE INDEX IF NOT EXISTS device_stats_timestamp ON device_stats (timestamp)')
+        conn.execute(CREATE_VIEW)
+
+def is_legacy(conn):
+    """Return True if device_stats still has the original unindexed, text-valued layout"""
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(device_stats)')]
+    return bool(columns) and columns[0] == 'timestamp'
+
+class Encoder():
+    """Map categorical values to lookup ids, adding new values to the lookup tables as they appear."""
+    def __init__(self, conn) -> None:
+        self.conn = conn
+        self.reload()
+
+    def reload(self):
+        """Reread the lookup tables, e.g. after a rolled back transaction discarded new values"""
+        self.codes = {}
+        for column, table in LOOKUPS.items():
+            self.codes[column] = {value: id for id, value in self.conn.execute('SELECT id, value FROM ' + table)}
+
+    def code(self, column, value):
+        """Return the lookup id for value, creating it if needed"""
+        if value is None:
+            return None
+        codes = self.codes[column]
+        try:
+            return codes[value]
+        except KeyError:
+            table = LOOKUPS[column]
+            self.conn.execute('INSERT OR IGNORE INTO {} (value) VALUES (?)'.format(table), (value,))
+            codes[value] = self.conn.execute('SELECT id FROM {} WHERE value = ?'.format(table), (value,)).fetchone()[0]
+            return codes[value]
+
+    def encode(self, reading):
+        """Convert a reading in READING_COLUMNS order into a device_stats row"""
+        (timestamp, temperature, relative_humidity, dew_point, device_id, connectivity,
+         hvac, mode, eco_mode, eco_heat, eco_cool, set_point) = reading
+        return (self.code('device_id', device_id), timestamp, temperature, relative_humidity, dew_point,
+                self.code('connectivity', connectivity), self.code('hvac', hvac), self.code('mode', mode),
+                self.code('eco_mode', eco_mode), eco_heat, eco_cool, set_point)
@@ -0,0 +1,335 @@
+"""Push-based ingestion for room sensors (e.g. Raspberry Pi Pico W boards).
+
+Sensors send readings over UDP or HTTP POST (to /readings), either as JSON
+
+    {"id": "pico-kitchen", "t": 21.4, "h": 48.0, "ts": 1700000000}      (or a list of these)
+
+or as compact text, one reading per line
+
+    pico-kitchen,21.4,48.0,1700000000
+
+Temperatures are Celsius; humidity and timestamp are optional (the timestamp defaults to when the
+reading arrived). Readings are validated and normalized into the same rows the logger stores for
+thermostats (°F, dew point, connectivity ONLINE), queued, and handed to a sink, a spool.Spool or
+db_writer.BatchWriter, in batches of up to BATCH_SIZE rows or every FLUSH_INTERVAL seconds.
+
+The queue is bounded. When a burst fills it, UDP readings are dropped and HTTP requests get 503
+until it drains, so memory stays flat however fast sensors send. Each batch is written on a single
+worker thread, so one slow write holds up the next batch but never the event loop.
+
+    python sensor_server.py [homelog.db] [--udp-port 9999] [--http-port 8099]
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import math
+import threading
+import time
+
+import db_writer
+import metrics
+import nest
+import schema
+
+UDP_PORT = 9999
+HTTP_PORT = 8099
+MAX_QUEUE = 20000           # readings buffered before new ones are refused
+BATCH_SIZE = 2000           # readings per write
+FLUSH_INTERVAL = 0.5        # seconds a reading may wait for its batch to fill
+MAX_BODY = 1 << 20          # bytes accepted in one HTTP request
+MAX_CLOCK_SKEW = 300        # seconds a sensor timestamp may be ahead of ours
+MIN_TIMESTAMP = 946684800   # 2000-01-01; older timestamps are a sensor without a clock set
+
+# Accepted names for each field, compact first
+ALIASES = {
+    'id': ('id', 'device_id'),
+    't': ('t', 'temperature_c', 'temperature'),
+    'h': ('h', 'relative_humidity', 'humidity'),
+    'ts': ('ts', 'timestamp'),
+}
+
+class InvalidReading(ValueError):
+    pass
+
+def _field(reading, name):
+    for alias in ALIASES[name]:
+        if alias in reading:
+            return reading[alias]
+    return None
+
+def _number(value, name, low, high):
+    if value is None or value == '':
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise InvalidReading("{} is not a number: {!r}".format(name, value))
+    if math.isnan(value) or not low <= value <= high:
+        raise InvalidReading("{} out of range: {}".format(name, value))
+    return value
+
+def normalize(device_id, temperature, humidity=None, timestamp=None, now=None):
+    """Validate one reading and return it as a device_stats row in schema.READING_COLUMNS order"""
+    now = time.time() if now is None else now
+    if not isinstance(device_id, str) or not 0 < len(device_id) <= 64 or not device_id.isprintable():
+        raise InvalidReading("Bad sensor id: {!r}".format(device_id))
+    temperature = _number(temperature, 'temperature', -40, 85)
+    if temperature is None:
+        raise InvalidReading("Missing temperature")
+    humidity = _number(humidity, 'humidity', 0, 100)
+    timestamp = _number(timestamp, 'timestamp', MIN_TIMESTAMP, now + MAX_CLOCK_SKEW)
+    dew_point = nest.dew_point_c(temperature, humidity)
+    return (int(timestamp if timestamp is not None else now), nest.c_to_f(temperature), humidity,
+            nest.c_to_f(dew_point) if dew_point is not None else None, device_id, 'ONLINE',
+            None, None, None, None, None, None)
+
+def parse(payload, now=None):
+    """Parse a JSON or compact text payload. Returns (rows, number of invalid readings)."""
+    now = time.time() if now is None else now
+    rows = []
+    invalid = 0
+    payload = payload.strip()
+    if payload[:1] in (b'{', b'['):
+        try:
+            readings = json.loads(payload)
+        except ValueError:
+            return rows, 1
+        if isinstance(readings, dict):
+            readings = [readings]
+        for reading in readings:
+            try:
+                if not isinstance(reading, dict):
+                    raise InvalidReading("Not an object")
+                rows.append(normalize(_field(reading, 'id'), _field(reading, 't'), _field(reading, 'h'), _field(reading, 'ts'), now))
+            except InvalidReading:
+                invalid += 1
+    else:
+        for line in payload.split(b'\n'):
+            fields = line.decode('utf-8', 'replace').strip().split(',')
+            try:
+                if not 2 <= len(fields) <= 4:
+                    raise InvalidReading("Expected id,temperature[,humidity[,timestamp]]")
+                rows.append(normalize(*fields, now=now))
+            except InvalidReading:
+                invalid += 1
+    return rows, invalid
+
+class SensorServer():
+    """Accept sensor readings over UDP and HTTP and write them to a sink in batches"""
+    def __init__(self, sink, host='0.0.0.0', udp_port=UDP_PORT, http_port=HTTP_PORT,
+                 max_queue=MAX_QUEUE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL) -> None:
+        self.sink = sink
+        self.host = host
+        self.udp_port = udp_port
+        self.http_port = http_port
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.accepted = 0
+        self.invalid = 0
+        self.dropped = 0
+        self.written = 0
+        self.write_errors = 0
+        self.loop = None
+        self.queue = None
+        self.stopping = None
+        self.connections = {}
+        self.ready = threading.Event()
+        self.error = None
+        self.thread = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='SensorWriter')
+
+    def submit(self, rows):
+        """Queue parsed rows. Returns False, queuing nothing, if they do not all fit."""
+        if self.max_queue - self.queue.qsize() < len(rows):
+            self.dropped += len(rows)
+            metrics.inc('sensor_dropped_total', len(rows))
+            return False
+        for row in rows:
+            self.queue.put_nowait(row)
+        self.accepted += len(rows)
+        metrics.inc('sensor_readings_total', len(rows))
+        return True
+
+    def receive(self, payload):
+        """Parse and queue a payload. Returns (rows, invalid, queued)."""
+        rows, invalid = parse(payload)
+        if invalid:
+            self.invalid += invalid
+            metrics.inc('sensor_invalid_total', invalid)
+        return rows, invalid, self.submit(rows) if rows else True
+
+    def _write(self, batch):
+        with metrics.timer('sensor_write_seconds'):
+            self.sink.write_many(batch)
+
+    async def _writer(self):
+        """Move queued rows to the sink in batches until stopped and the queue is empty"""
+        while not (self.stopping.is_set() and self.queue.empty()):
+            try:
+                batch = [await asyncio.wait_for(self.queue.get(), self.flush_interval)]
+            except asyncio.TimeoutError:
+                continue
+            deadline = self.loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if self.queue.empty():
+                    remaining = deadline - self.loop.time()
+                    if remaining <= 0 or self.stopping.is_set():
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self.queue.get_nowait())
+            try:
+                await self.loop.run_in_executor(self.executor, self._write, batch)
+                self.written += len(batch)
+            except Exception as e:
+                print("Error writing {} sensor readings: {}".format(len(batch), e))
+                self.write_errors += 1
+
+    async def _handle_http(self, reader, writer):
+        self.connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                method, path = (request.decode('latin-1').split() + ['', ''])[:2]
+                length = 0
+                close = False
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    name = name.strip().lower()
+                    if name == 'content-length':
+                        value = value.strip() or '0'
+                        # Without a usable length the end of the body is unknown, so the connection is closed
+                        length = int(value) if value.isascii() and value.isdigit() else None
+                    elif name == 'connection' and value.strip().lower() == 'close':
+                        close = True
+                if length is None:
+                    status, body, close = 400, {'error': 'Bad Content-Length'}, True
+                elif length > MAX_BODY:
+                    status, body, close = 413, {'error': 'Request too large'}, True
+                elif method != 'POST' or path.split('?')[0] != '/readings':
+                    # Discard the body so the next request on this connection starts where it should
+                    await reader.readexactly(length)
+                    status, body = 404, {'error': 'POST readings to /readings'}
+                else:
+                    rows, invalid, queued = self.receive(await reader.readexactly(length))
+                    if not queued:
+                        status, body = 503, {'error': 'Busy, retry later', 'invalid': invalid}
+                    elif not rows and invalid:
+                        status, body = 400, {'error': 'No valid readings', 'invalid': invalid}
+                    else:
+                        status, body = 202, {'accepted': len(rows), 'invalid': invalid}
+                data = json.dumps(body).encode()
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n{}\r\n'.format(
+                    status, HTTP_REASONS[status], len(data), 'Connection: close\r\n' if close else '').encode() + data)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            del self.connections[asyncio.current_task()]
+            writer.close()
+
+    async def serve(self):
+        """Run the UDP and HTTP listeners and the batch writer until stop() is called"""
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.stopping = asyncio.Event()
+        writer = self.loop.create_task(self._writer())
+        transport = http = None
+        try:
+            if self.udp_port is not None:
+                transport, _ = await self.loop.create_datagram_endpoint(lambda: _Datagrams(self), local_addr=(self.host, self.udp_port))
+                self.udp_port = transport.get_extra_info('sockname')[1]
+            if self.http_port is not None:
+                http = await asyncio.start_server(self._handle_http, self.host, self.http_port)
+                self.http_port = http.sockets[0].getsockname()[1]
+        except Exception as e:
+            # e.g. the port is in use; start() raises it, and whatever was bound is closed below
+            self.error = e
+            self.stopping.set()
+        finally:
+            self.ready.set()
+        try:
+            await self.stopping.wait()
+        finally:
+            if transport is not None:
+                transport.close()
+            if http is not None:
+                http.close()
+                # Hang up idle keep-alive connections so their handlers finish
+                for connection in list(self.connections.values()):
+                    connection.close()
+                await asyncio.gather(*self.connections, return_exceptions=True)
+                await http.wait_closed()
+            # Write out whatever was accepted before stopping
+            await writer
+            self.executor.shutdown(wait=True)
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        try:
+            asyncio.run(self.serve())
+        except Exception:
+            # Binding failed; start() raises the error in the caller's thread
+            if self.error is None:
+                raise
+
+    def start(self):
+        """Serve from a background thread. Returns once the listeners are bound; raises if they cannot be."""
+        self.thread = threading.Thread(target=self._run, name='SensorServer', daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            self.thread.join()
+            raise self.error
+        return self
+
+    def stop(self):
+        """Stop listening, write out the queued readings and wait for the server to finish"""
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopping.set)
+        if self.thread is not None:
+            self.thread.join()
+
+class _Datagrams(asyncio.DatagramProtocol):
+    def __init__(self, server) -> None:
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.receive(data)
+
+HTTP_REASONS = {202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Receive room sensor readings and store them in homelog.db')
+    parser.add_argument('db', nargs='?', default='homelog.db')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--udp-port', type=int, default=UDP_PORT)
+    parser.add_argument('--http-port', type=int, default=HTTP_PORT)
+    args = parser.parse_args()
+
+    conn = db_writer.connect(args.db)
+    if schema.is_legacy(conn):
+        raise SystemExit("device_stats uses the old layout; run migrate_db.py first")
+    schema.create_tables(conn)
+    with db_writer.BatchWriter(conn, max_rows=BATCH_SIZE, max_age=5) as sink:
+        server = SensorServer(sink, args.host, args.udp_port, args.http_port)
+        print("Listening for sensors on UDP {} and HTTP {}".format(args.udp_port, args.http_port))
+        try:
+            asyncio.run(server.serve())
+        except KeyboardInterrupt:
+            pass
+    conn.close()
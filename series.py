@@ -0,0 +1,165 @@
+"""Columnar reads of homelog.db into NumPy arrays.
+
+load_series() streams device_stats rows from SQLite in chunks straight into a structured array, so
+a year of readings costs a few megabytes instead of a list of Python tuples. Missing measurements
+are NaN and categorical fields are their integer lookup codes (-1 when missing); use lookup() to map
+codes back to text.
+"""
+
+import itertools
+
+import numpy as np
+
+import schema
+
+CHUNK_SIZE = 65536
+
+# NumPy type of each device_stats column that can be loaded
+FIELD_TYPES = {
+    'temperature': 'f8',
+    'relative_humidity': 'f8',
+    'dew_point': 'f8',
+    'eco_heat': 'f8',
+    'eco_cool': 'f8',
+    'set_point': 'f8',
+    'connectivity': 'i4',
+    'hvac': 'i4',
+    'mode': 'i4',
+    'eco_mode': 'i4',
+}
+
+DEFAULT_FIELDS = ('temperature', 'relative_humidity', 'dew_point')
+
+def _select(field):
+    # Integer codes cannot hold NaN, so missing categories come back as -1
+    if FIELD_TYPES[field][0] == 'i':
+        return 'ifnull({}, -1)'.format(field)
+    return field
+
+def load_series(conn, device_id=None, start=None, end=None, fields=DEFAULT_FIELDS, chunk_size=CHUNK_SIZE):
+    """Load readings in [start, end) as a structured array ordered by timestamp.
+
+    The array has a 'timestamp' field followed by the requested fields. If device_id is None,
+    all devices are loaded and a 'device_id' field holds each row's device code.
+    """
+    for field in fields:
+        if field not in FIELD_TYPES:
+            raise ValueError("Unknown field: {}".format(field))
+    dtype = [('timestamp', 'i8')]
+    columns = ['timestamp']
+    where = []
+    params = []
+    if device_id is None:
+        dtype.append(('device_id', 'i4'))
+        columns.append('device_id')
+    else:
+        code = conn.execute('SELECT id FROM device_lookup WHERE value = ?', (device_id,)).fetchone()
+        if code is None:
+            return np.empty(0, dtype=dtype + [(field, FIELD_TYPES[field]) for field in fields])
+        where.append('device_id = ?')
+        params.append(code[0])
+    dtype += [(field, FIELD_TYPES[field]) for field in fields]
+    columns += [_select(field) for field in fields]
+    if start is not None:
+        where.append('timestamp >= ?')
+        params.append(start)
+    if end is not None:
+        where.append('timestamp < ?')
+        params.append(end)
+    sql = 'SELECT {} FROM device_stats'.format(', '.join(columns))
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY timestamp'
+
+    cursor = conn.execute(sql, params)
+    chunks = []
+    while True:
+        chunk = np.fromiter(itertools.islice(cursor, chunk_size), dtype=dtype)
+        if len(chunk):
+            chunks.append(chunk)
+        if len(chunk) < chunk_size:
+            break
+    if len(chunks) == 1:
+        return chunks[0]
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+
+def load_weather(conn, start=None, end=None, fields=('temp', 'humidity', 'dew_point'), table='weather_current'):
+    """Load stored weather in [start, end) as a structured array with a 'dt' field, ordered by time.
+
+    Pass the result's 'dt' and fields to asof_join to line outdoor conditions up with readings.
+    """
+    dtype = [('dt', 'i8')] + [(field, 'f8') for field in fields]
+    where = []
+    params = []
+    if start is not None:
+        where.append('dt >= ?')
+        params.append(start)
+    if end is not None:
+        where.append('dt < ?')
+        params.append(end)
+    sql = 'SELECT dt, {} FROM {}'.format(', '.join(fields), table)
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    return np.fromiter(conn.execute(sql + ' ORDER BY dt', params), dtype=dtype)
+
+def lookup(conn, column):
+    """Return the lookup table for a categorical column as {code: value}"""
+    return dict(conn.execute('SELECT id, value FROM ' + schema.LOOKUPS[column]))
+
+def resample(timestamps, values, interval, how='mean'):
+    """Aggregate sorted samples into fixed buckets of interval seconds.
+
+    Returns (bucket_starts, aggregated) for the buckets that contain samples. NaN values are
+    ignored; a bucket with only NaN values aggregates to NaN. how is 'mean', 'min', 'max' or 'last'.
+    """
+    timestamps = np.asarray(timestamps)
+    values = np.asarray(values, dtype='f8')
+    if len(timestamps) == 0:
+        return timestamps[:0], values[:0]
+    buckets = timestamps - timestamps % interval
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    valid = ~np.isnan(values)
+    counts = np.add.reduceat(valid, starts)
+    if how == 'mean':
+        sums = np.add.reduceat(np.where(valid, values, 0.0), starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = sums / counts
+    elif how == 'min':
+        result = np.minimum.reduceat(np.where(valid, values, np.inf), starts)
+    elif how == 'max':
+        result = np.maximum.reduceat(np.where(valid, values, -np.inf), starts)
+    elif how == 'last':
+        # Index of the last valid sample in each bucket
+        index = np.maximum.reduceat(np.where(valid, np.arange(len(values)), -1), starts)
+        result = values[np.maximum(index, 0)]
+    else:
+        raise ValueError("Unknown aggregation: {}".format(how))
+    result = np.where(counts > 0, result, np.nan)
+    return buckets[starts], result
+
+def asof_join(timestamps, other_timestamps, other_values, tolerance=None):
+    """For each timestamp, take the latest of other_values at or before it.
+
+    other_timestamps must be sorted. Timestamps with no earlier sample, or whose latest sample is
+    more than tolerance seconds old, get NaN (or NaN in every float field of a structured array).
+    """
+    timestamps = np.asarray(timestamps)
+    other_timestamps = np.asarray(other_timestamps)
+    other_values = np.asarray(other_values)
+    index = np.searchsorted(other_timestamps, timestamps, side='right') - 1
+    missing = index < 0
+    index = np.maximum(index, 0)
+    if tolerance is not None and len(other_timestamps):
+        missing |= timestamps - other_timestamps[index] > tolerance
+    if len(other_values) == 0:
+        missing[:] = True
+        other_values = np.zeros(1, dtype=other_values.dtype)
+    result = other_values[index]
+    if other_values.dtype.names:
+        for name in other_values.dtype.names:
+            if result.dtype[name].kind == 'f':
+                result[name][missing] = np.nan
+    else:
+        result = result.astype('f8')
+        result[missing] = np.nan
+    return result
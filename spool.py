@@ -0,0 +1,192 @@
+"""Durable on-disk queue between the pollers and the database.
+
+The logger appends readings to the spool instead of writing to SQLite, so a locked database or a
+full disk never blocks or crashes a poll. A Drainer thread moves spooled readings into the
+database in bulk and deletes them once they are committed.
+
+The spool is a directory of append-only segment files. Each record is framed as
+
+    length (4 bytes, little endian) | crc32 of payload (4 bytes) | payload (JSON list of readings)
+
+Drain seals the current segment and starts a new one, so appends never wait on the database.
+A sealed segment is deleted only after its readings are committed. If the process dies between
+the commit and the delete, the segment is replayed on the next drain, and the (device_id, timestamp)
+primary key makes the replay a no-op. Every reading is stored exactly once. A record cut short by a
+crash fails its length or checksum; it and anything after it in that segment are reported and
+dropped. A segment that fails for any reason other than the database being unavailable (locked,
+full, I/O error) is retried MAX_ATTEMPTS times, then moved to the quarantine subdirectory so it
+cannot hold up the segments behind it.
+"""
+
+import json
+import os
+import sqlite3
+import struct
+import threading
+import zlib
+
+import db_writer
+import metrics
+import schema
+
+SPOOL_DIR = 'spool'
+DRAIN_INTERVAL = 10     # seconds between drains
+MAX_ATTEMPTS = 5        # failed drains of a segment before it is quarantined
+QUARANTINE_DIR = 'quarantine'
+HEADER = struct.Struct('<II')
+
+def encode_record(rows):
+    """Frame a list of readings as one record"""
+    payload = json.dumps(rows, separators=(',', ':')).encode()
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+def read_records(path):
+    """Yield the readings of each intact record in a segment, stopping at the first damaged one"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        if offset + HEADER.size > len(data):
+            print("Spool segment {} ends in a partial header; dropping {} bytes".format(path, len(data) - offset))
+            return
+        length, crc = HEADER.unpack_from(data, offset)
+        payload = data[offset + HEADER.size:offset + HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            print("Spool segment {} has a damaged record at byte {}; dropping {} bytes".format(path, offset, len(data) - offset))
+            metrics.inc('spool_damaged_records_total')
+            return
+        yield [tuple(row) for row in json.loads(payload)]
+        offset += HEADER.size + length
+
+class Spool():
+    """Append-only segment files holding readings until they are drained"""
+    def __init__(self, directory=SPOOL_DIR, sync=True) -> None:
+        self.directory = directory
+        self.sync = sync
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        existing = self.segments()
+        self.sequence = self._sequence(existing[-1]) + 1 if existing else 0
+        self.file = None
+
+    def _path(self, sequence):
+        return os.path.join(self.directory, 'spool-{:08d}.log'.format(sequence))
+
+    def _sequence(self, path):
+        return int(os.path.basename(path)[len('spool-'):-len('.log')])
+
+    def segments(self):
+        """Return the segment files in the order they were written"""
+        names = sorted(name for name in os.listdir(self.directory) if name.startswith('spool-') and name.endswith('.log'))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def write(self, row):
+        """Append one reading"""
+        self.write_many([row])
+
+    def write_many(self, rows):
+        """Append readings as a single record"""
+        record = encode_record(list(rows))
+        with self.lock:
+            if self.file is None:
+                self.file = open(self._path(self.sequence), 'ab')
+            self.file.write(record)
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+        metrics.inc('spool_records_total')
+
+    def seal(self):
+        """Close the current segment so the next append starts a new one. Returns the sealed segments."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.sequence += 1
+            return [path for path in self.segments() if self._sequence(path) < self.sequence]
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class Drainer():
+    """Move spooled readings into the database in the background"""
+    def __init__(self, spool, conn, interval=DRAIN_INTERVAL, on_commit=None, max_attempts=MAX_ATTEMPTS) -> None:
+        self.spool = spool
+        self.conn = conn
+        self.on_commit = on_commit
+        self.encoder = schema.Encoder(conn)
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.failures = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def quarantine(self, path):
+        """Move a segment that cannot be drained out of the way. Returns its new path."""
+        directory = os.path.join(self.spool.directory, QUARANTINE_DIR)
+        os.makedirs(directory, exist_ok=True)
+        target = os.path.join(directory, os.path.basename(path))
+        os.replace(path, target)
+        self.failures.pop(path, None)
+        metrics.inc('spool_quarantined_segments_total')
+        return target
+
+    def drain(self):
+        """Commit every sealed segment to the database and delete it. Returns the number of readings inserted.
+
+        Raises sqlite3.OperationalError, leaving the remaining segments for the next drain, if the
+        database is unavailable.
+        """
+        inserted = 0
+        for path in self.spool.seal():
+            try:
+                rows = [row for record in read_records(path) for row in record]
+                if rows:
+                    inserted += db_writer.insert_rows(self.conn, self.encoder, rows)
+                    # Before the delete, so a failure here is retried with the segment
+                    if self.on_commit is not None:
+                        self.on_commit(rows)
+            except sqlite3.OperationalError:
+                raise
+            except Exception as e:
+                attempts = self.failures[path] = self.failures.get(path, 0) + 1
+                metrics.inc('spool_drain_errors_total')
+                if attempts >= self.max_attempts:
+                    print("Spool segment {} failed {} times ({}); moved to {}".format(path, attempts, e, self.quarantine(path)))
+                else:
+                    print("Error draining spool segment {} (attempt {}): {}".format(path, attempts, e))
+                continue
+            os.remove(path)
+            self.failures.pop(path, None)
+        metrics.inc('spool_drained_rows_total', inserted)
+        return inserted
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.drain()
+            except Exception as e:
+                print("Error draining spool:", e)
+                metrics.inc('spool_drain_errors_total')
+
+    def start(self):
+        """Drain anything left from a previous run, then keep draining every interval seconds"""
+        try:
+            self.drain()
+        except Exception as e:
+            print("Error draining spool:", e)
+        self.thread = threading.Thread(target=self._run, name='SpoolDrainer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread and make a final attempt to drain"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            self.drain()
+        except Exception as e:
+            print("Error draining spool; readings stay spooled for the next run:", e)
@@ -0,0 +1,249 @@
+"""In-memory latest state and recent history for control decisions.
+
+StateCache keeps, per device, the latest reading and a fixed-size ring buffer of recent samples
+for temperature, relative humidity and dew point. Outdoor conditions from weather_ingest are kept
+the same way under the device name OUTDOOR. Every read is O(1) and never touches SQLite:
+
+    cache.latest('living-room')                 # the last row, as a dict of READING_COLUMNS
+    cache.mean('living-room', 'temperature')    # over the samples in the ring
+    cache.slope('outdoor', 'temperature')       # least-squares trend, per hour
+
+Rings keep running sums of t, v, t*t and t*v, so the rolling mean and slope are updated in
+constant time as samples enter and leave. Each time the buffer wraps, the times are rebased on the
+oldest sample and the sums recomputed, so rounding errors cannot build up.
+
+The cache is a sink like spool.Spool and db_writer.BatchWriter (write/write_many take rows in
+schema.READING_COLUMNS order); Tee feeds it alongside the real writer. warm() fills it from the
+database at startup.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+import schema
+import series
+
+CAPACITY = 288              # samples per ring: a day of 5-minute readings
+METRICS = ('temperature', 'relative_humidity', 'dew_point')
+OUTDOOR = 'outdoor'         # device name for weather_ingest's current conditions
+
+# weather_current columns for each metric
+WEATHER_FIELDS = {'temperature': 'temp', 'relative_humidity': 'humidity', 'dew_point': 'dew_point'}
+
+class Ring():
+    """Fixed-size ring buffer of (timestamp, value) samples with running sums"""
+    __slots__ = ('times', 'values', 'capacity', 'count', 'next', 'origin', 'st', 'sv', 'stt', 'stv')
+
+    def __init__(self, capacity=CAPACITY) -> None:
+        self.times = np.zeros(capacity)
+        self.values = np.zeros(capacity)
+        self.capacity = capacity
+        self.count = 0
+        self.next = 0
+        # Times are stored relative to an origin near the oldest sample so t*t keeps its precision
+        self.origin = None
+        self.st = self.sv = self.stt = self.stv = 0.0
+
+    def push(self, timestamp, value):
+        """Add a sample, evicting the oldest when full. NaN and None values are ignored."""
+        if value is None or value != value:
+            return
+        if self.origin is None:
+            self.origin = timestamp
+        t = float(timestamp - self.origin)
+        if self.count == self.capacity:
+            old_t = self.times[self.next]
+            old_v = self.values[self.next]
+            self.st -= old_t
+            self.sv -= old_v
+            self.stt -= old_t * old_t
+            self.stv -= old_t * old_v
+        else:
+            self.count += 1
+        self.times[self.next] = t
+        self.values[self.next] = value
+        self.st += t
+        self.sv += value
+        self.stt += t * t
+        self.stv += t * value
+        self.next = (self.next + 1) % self.capacity
+        if self.next == 0:
+            self._resum()
+
+    def extend(self, timestamps, values):
+        """Add many samples in time order, keeping the newest capacity of them"""
+        timestamps = np.asarray(timestamps, dtype='f8')
+        values = np.asarray(values, dtype='f8')
+        valid = ~np.isnan(values)
+        timestamps = timestamps[valid][-self.capacity:]
+        values = values[valid][-self.capacity:]
+        if not len(values):
+            return
+        if self.count:
+            for timestamp, value in zip(timestamps.tolist(), values.tolist()):
+                self.push(timestamp, value)
+            return
+        self.origin = timestamps[0]
+        self.count = len(values)
+        self.times[:self.count] = timestamps - self.origin
+        self.values[:self.count] = values
+        self.next = self.count % self.capacity
+        self._resum()
+
+    def _resum(self):
+        times = self.times[:self.count]
+        values = self.values[:self.count]
+        shift = times[self.next if self.count == self.capacity else 0]
+        times -= shift
+        self.origin += shift
+        self.st = float(times.sum())
+        self.sv = float(values.sum())
+        self.stt = float(times @ times)
+        self.stv = float(times @ values)
+
+    def __len__(self):
+        return self.count
+
+    def last(self):
+        """Return the newest (timestamp, value), or None when empty"""
+        if not self.count:
+            return None
+        index = self.next - 1
+        return self.origin + self.times[index], self.values[index]
+
+    def mean(self):
+        return self.sv / self.count if self.count else None
+
+    def slope(self):
+        """Least-squares slope of value against time, per second; None with fewer than two samples"""
+        denominator = self.count * self.stt - self.st * self.st
+        if self.count < 2 or denominator <= 0:
+            return None
+        return (self.count * self.stv - self.st * self.sv) / denominator
+
+    def samples(self):
+        """Return copies of the timestamps and values, oldest first"""
+        if self.count < self.capacity:
+            order = slice(0, self.count)
+            return self.times[order] + self.origin, self.values[order].copy()
+        order = np.r_[self.next:self.capacity, 0:self.next]
+        return self.times[order] + self.origin, self.values[order]
+
+class StateCache():
+    """Latest reading and recent samples per device, updated by the logger and weather ingestion"""
+    def __init__(self, capacity=CAPACITY, metrics=METRICS) -> None:
+        self.capacity = capacity
+        self.metrics = metrics
+        self.indexes = [schema.READING_COLUMNS.index(metric) for metric in metrics]
+        self.readings = {}
+        self.rings = {}
+        self.lock = threading.Lock()
+
+    def _ring(self, device, metric):
+        ring = self.rings.get((device, metric))
+        if ring is None:
+            ring = self.rings[(device, metric)] = Ring(self.capacity)
+        return ring
+
+    def write(self, row):
+        """Record a reading in schema.READING_COLUMNS order"""
+        self.write_many((row,))
+
+    def write_many(self, rows):
+        with self.lock:
+            for row in rows:
+                device = row[4]
+                latest = self.readings.get(device)
+                if latest is not None and row[0] <= latest[0]:
+                    # A late reading (e.g. replayed from the spool) is already out of the window
+                    continue
+                self.readings[device] = row
+                for metric, index in zip(self.metrics, self.indexes):
+                    self._ring(device, metric).push(row[0], row[index])
+
+    def update_weather(self, current, device=OUTDOOR):
+        """Record the current section of a One Call response"""
+        with self.lock:
+            latest = self.readings.get(device)
+            if latest is not None and current['dt'] <= latest[0]:
+                return
+            row = {'timestamp': current['dt']}
+            for metric in self.metrics:
+                row[metric] = current.get(WEATHER_FIELDS[metric])
+                self._ring(device, metric).push(current['dt'], row[metric])
+            row['device_id'] = device
+            self.readings[device] = tuple(row.get(column) for column in schema.READING_COLUMNS)
+
+    def devices(self):
+        return list(self.readings)
+
+    def latest(self, device):
+        """Return the newest reading of a device as a dict, or None"""
+        row = self.readings.get(device)
+        return dict(zip(schema.READING_COLUMNS, row)) if row is not None else None
+
+    def mean(self, device, metric):
+        """Mean of the samples in the ring, or None"""
+        ring = self.rings.get((device, metric))
+        with self.lock:
+            return ring.mean() if ring is not None else None
+
+    def slope(self, device, metric):
+        """Trend of the samples in the ring in units per hour, or None"""
+        ring = self.rings.get((device, metric))
+        with self.lock:
+            slope = ring.slope() if ring is not None else None
+        return slope * 3600 if slope is not None else None
+
+    def samples(self, device, metric):
+        """Return (timestamps, values) in the ring, oldest first"""
+        ring = self.rings.get((device, metric))
+        with self.lock:
+            return ring.samples() if ring is not None else (np.empty(0), np.empty(0))
+
+    def warm(self, conn, window=None, now=None):
+        """Fill the cache from the database: the latest reading of each device and the samples of the last window seconds.
+
+        window defaults to capacity 5-minute intervals.
+        """
+        now = time.time() if now is None else now
+        start = int(now - (window if window is not None else self.capacity * 300))
+        names = series.lookup(conn, 'device_id')
+        history = series.load_series(conn, None, start, None, self.metrics)
+        readings = {}
+        for code, device in names.items():
+            row = conn.execute('SELECT * FROM device_readings WHERE device_id = ? ORDER BY timestamp DESC LIMIT 1', (device,)).fetchone()
+            if row is not None:
+                readings[device] = row
+        weather = None
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'weather_current'").fetchone():
+            weather = series.load_weather(conn, start, None, tuple(WEATHER_FIELDS[metric] for metric in self.metrics))
+        with self.lock:
+            self.readings.update(readings)
+            for code, device in names.items():
+                samples = history[history['device_id'] == code]
+                for metric in self.metrics:
+                    self._ring(device, metric).extend(samples['timestamp'], samples[metric])
+            if weather is not None and len(weather):
+                for metric in self.metrics:
+                    self._ring(OUTDOOR, metric).extend(weather['dt'], weather[WEATHER_FIELDS[metric]])
+                last = weather[-1]
+                row = {metric: float(last[WEATHER_FIELDS[metric]]) for metric in self.metrics}
+                row.update(timestamp=int(last['dt']), device_id=OUTDOOR)
+                self.readings[OUTDOOR] = tuple(row.get(column) for column in schema.READING_COLUMNS)
+        return len(history)
+
+class Tee():
+    """Send rows to several sinks, e.g. the spool and a StateCache"""
+    def __init__(self, *sinks) -> None:
+        self.sinks = sinks
+
+    def write(self, row):
+        self.write_many((row,))
+
+    def write_many(self, rows):
+        rows = list(rows)
+        for sink in self.sinks:
+            sink.write_many(rows)
@@ -0,0 +1,93 @@
+"""Exports of device_stats around retention's raw horizon.
+
+    python -m unittest discover tests
+"""
+
+import csv
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_writer
+import export
+import retention
+import rollup
+import schema
+
+START = 1704067200          # 2024-01-01 00:00 UTC
+APRIL = 1711929600          # 2024-04-01 00:00 UTC
+
+def reading(timestamp, temperature=70.0):
+    return (timestamp, temperature, 45.0, 48.0, 'thermostat', 'ONLINE', 'OFF', 'HEAT', 'OFF', 62.0, 80.0, 68.0)
+
+def exported_times(path, format):
+    """Return the timestamps in a partition file, in file order"""
+    if format == 'parquet':
+        return export.pyarrow.parquet.read_table(path).column('timestamp').to_pylist()
+    with open(path, newline='') as f:
+        return [int(row['timestamp']) for row in csv.DictReader(f)]
+
+class RetentionExportTest(unittest.TestCase):
+    format = 'csv'
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.tmp.name, 'export')
+        self.conn = db_writer.connect(os.path.join(self.tmp.name, 'homelog.db'))
+        schema.create_tables(self.conn)
+        rollup.create_tables(self.conn)
+        # Hourly readings from January to the end of March
+        self.times = list(range(START, APRIL, rollup.HOUR))
+        self.insert([reading(timestamp) for timestamp in self.times])
+        rollup.update(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp.cleanup()
+
+    def insert(self, rows):
+        with db_writer.BatchWriter(self.conn, max_age=None) as writer:
+            writer.write_many(rows)
+
+    def path(self, key):
+        return os.path.join(self.output, 'device_stats', '{}.{}'.format(key, self.format))
+
+    def test_retention_then_new_rows(self):
+        export.export(self.conn, self.output, 'month', self.format)
+        originals = {key: os.path.getmtime(self.path(key)) for key in ('2024-01', '2024-02')}
+
+        # Keep 16 days: the horizon falls on 2024-03-16, in the middle of the March partition
+        retention.purge(self.conn, 16, pause=0, now=APRIL)
+        horizon = rollup.raw_horizon(self.conn)
+        self.assertTrue(START < horizon < APRIL)
+        self.assertGreater(horizon, 1709251200)
+        late = APRIL - 1800
+        self.insert([reading(late), reading(APRIL), reading(APRIL + rollup.HOUR)])
+        summary = export.export(self.conn, self.output, 'month', self.format)
+
+        # January and February ended before the horizon and are left alone; March and April are written
+        self.assertEqual(summary['device_stats'][0], 2)
+        for key, mtime in originals.items():
+            self.assertEqual(os.path.getmtime(self.path(key)), mtime)
+        march = [timestamp for timestamp in self.times if timestamp >= 1709251200] + [late]
+        self.assertEqual(exported_times(self.path('2024-03'), self.format), sorted(march))
+        self.assertEqual(exported_times(self.path('2024-04'), self.format), [APRIL, APRIL + rollup.HOUR])
+
+        # Unchanged since: nothing is rewritten
+        self.assertEqual(export.export(self.conn, self.output, 'month', self.format)['device_stats'][0], 0)
+
+        # A full export rewrites what is in the database but keeps the history retention deleted
+        export.export(self.conn, self.output, 'month', self.format, full=True)
+        history = [timestamp for timestamp in self.times if timestamp < 1709251200]
+        self.assertEqual(exported_times(self.path('2024-01'), self.format) + exported_times(self.path('2024-02'), self.format), history)
+        self.assertEqual(exported_times(self.path('2024-03'), self.format), sorted(march))
+
+@unittest.skipIf(export.pyarrow is None, 'pyarrow is not installed')
+class ParquetRetentionExportTest(RetentionExportTest):
+    format = 'parquet'
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""Store OpenWeather One Call data in homelog.db.
+
+WeatherIngest fetches the One Call response for a location and writes the current conditions,
+hourly forecast and daily forecast to weather_current, weather_hourly and weather_daily. Responses
+are cached for ttl seconds, in memory and in the weather_cache table, so repeated lookups for the
+same location (including after a restart) do not spend API quota. The logger polls get() on its own
+schedule, independent of the Nest loop. If given a state_cache.StateCache, each fetch also updates
+its outdoor conditions.
+"""
+
+import json
+import threading
+import time
+
+import metrics
+import openweather
+
+TTL = 600                # seconds a One Call response is reused
+POLL_INTERVAL = 900      # seconds between polls; 96 calls a day stays well inside the free quota
+UNITS = 'imperial'
+
+CURRENT_FIELDS = ('temp', 'feels_like', 'humidity', 'dew_point', 'pressure', 'clouds', 'uvi', 'visibility',
+                  'wind_speed', 'wind_deg', 'wind_gust', 'sunrise', 'sunset')
+HOURLY_FIELDS = ('temp', 'feels_like', 'humidity', 'dew_point', 'pressure', 'clouds', 'uvi', 'visibility',
+                 'wind_speed', 'wind_deg', 'wind_gust', 'pop')
+DAILY_FIELDS = ('humidity', 'dew_point', 'pressure', 'clouds', 'uvi', 'wind_speed', 'wind_deg', 'wind_gust',
+                'pop', 'sunrise', 'sunset', 'moonrise', 'moonset', 'moon_phase')
+
+TIME_FIELDS = ('sunrise', 'sunset', 'moonrise', 'moonset')
+
+def _columns(fields):
+    return ', '.join(field + (' INTEGER' if field in TIME_FIELDS else ' REAL') for field in fields)
+
+def create_tables(conn):
+    """Create the weather tables"""
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS weather_current
+                        (lat REAL NOT NULL, lon REAL NOT NULL, dt INTEGER NOT NULL, {}, weather_id INTEGER, description TEXT,
+                         PRIMARY KEY (lat, lon, dt)) WITHOUT ROWID'''.format(_columns(CURRENT_FIELDS)))
+        conn.execute('''CREATE TABLE IF NOT EXISTS weather_hourly
+                        (lat REAL NOT NULL, lon REAL NOT NULL, dt INTEGER NOT NULL, fetched_at INTEGER, {}, weather_id INTEGER, description TEXT,
+                         PRIMARY KEY (lat, lon, dt)) WITHOUT ROWID'''.format(_columns(HOURLY_FIELDS)))
+        conn.execute('''CREATE TABLE IF NOT EXISTS weather_daily
+                        (lat REAL NOT NULL, lon REAL NOT NULL, dt INTEGER NOT NULL, fetched_at INTEGER, summary TEXT, temp_min REAL, temp_max REAL, {},
+                         weather_id INTEGER, description TEXT,
+                         PRIMARY KEY (lat, lon, dt)) WITHOUT ROWID'''.format(_columns(DAILY_FIELDS)))
+        conn.execute('''CREATE TABLE IF NOT EXISTS weather_cache
+                        (lat REAL NOT NULL, lon REAL NOT NULL, units TEXT NOT NULL, fetched_at INTEGER NOT NULL, response TEXT NOT NULL,
+                         PRIMARY KEY (lat, lon, units))''')
+        conn.execute('CREATE INDEX IF NOT EXISTS weather_current_dt ON weather_current (dt)')
+        conn.execute('CREATE INDEX IF NOT EXISTS weather_hourly_dt ON weather_hourly (dt)')
+
+def _weather(entry):
+    weather = entry.get('weather') or [{}]
+    return weather[0].get('id'), weather[0].get('description')
+
+def store_response(conn, lat, lon, response, fetched_at):
+    """Write the current, hourly and daily sections of a One Call response"""
+    with conn:
+        current = response.get('current')
+        if current:
+            conn.execute('INSERT OR REPLACE INTO weather_current VALUES ({})'.format(', '.join('?' * (len(CURRENT_FIELDS) + 5))),
+                         (lat, lon, current['dt']) + tuple(current.get(field) for field in CURRENT_FIELDS) + _weather(current))
+        # A newer forecast for the same hour or day replaces the older one
+        conn.executemany('INSERT OR REPLACE INTO weather_hourly VALUES ({})'.format(', '.join('?' * (len(HOURLY_FIELDS) + 6))),
+                         [(lat, lon, hour['dt'], fetched_at) + tuple(hour.get(field) for field in HOURLY_FIELDS) + _weather(hour)
+                          for hour in response.get('hourly', ())])
+        conn.executemany('INSERT OR REPLACE INTO weather_daily VALUES ({})'.format(', '.join('?' * (len(DAILY_FIELDS) + 9))),
+                         [(lat, lon, day['dt'], fetched_at, day.get('summary'), day['temp']['min'], day['temp']['max'])
+                          + tuple(day.get(field) for field in DAILY_FIELDS) + _weather(day)
+                          for day in response.get('daily', ())])
+
+class WeatherIngest():
+    """Fetch, cache and store One Call responses for one or more locations."""
+    def __init__(self, conn, api_key, units=UNITS, ttl=TTL, url=openweather.ONECALL_URL, state=None) -> None:
+        self.conn = conn
+        self.state = state
+        self.api_key = api_key
+        self.url = url
+        self.units = units
+        self.ttl = ttl
+        self.cache = {}
+        self.lock = threading.Lock()
+        create_tables(conn)
+
+    def key(self, lat, lon):
+        # One Call data has ~1 km resolution, so nearby coordinates share a cache entry
+        return (round(lat, 2), round(lon, 2), self.units)
+
+    def cached(self, lat, lon):
+        """Return a cached response younger than the TTL, or None"""
+        key = self.key(lat, lon)
+        now = time.time()
+        entry = self.cache.get(key)
+        if entry is None:
+            row = self.conn.execute('SELECT fetched_at, response FROM weather_cache WHERE lat = ? AND lon = ? AND units = ?', key).fetchone()
+            if row is not None:
+                entry = self.cache[key] = (row[0], json.loads(row[1]))
+        if entry is not None and now - entry[0] < self.ttl:
+            return entry[1]
+        return None
+
+    def get(self, lat, lon):
+        """Return the One Call response for a location, fetching and storing it if the cache is stale"""
+        with self.lock:
+            response = self.cached(lat, lon)
+            if response is not None:
+                metrics.inc('weather_cache_hits_total')
+                return response
+            key = self.key(lat, lon)
+            response = openweather.get_weather_data(key[0], key[1], self.units, self.api_key, url=self.url)
+            if 'current' not in response:
+                raise ValueError("OpenWeather error: {}".format(response.get('message', response)))
+            fetched_at = int(time.time())
+            self.cache[key] = (fetched_at, response)
+            store_response(self.conn, key[0], key[1], response, fetched_at)
+            if self.state is not None:
+                self.state.update_weather(response['current'])
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO weather_cache VALUES (?, ?, ?, ?, ?)', key + (fetched_at, json.dumps(response)))
+            return response